@@ -0,0 +1,100 @@
+"""
+
+Running slow output tasks (checkpoint serialization, figure rendering, artifact uploads) on a background thread
+
+Tasks are run in the order they are submitted from a bounded queue, submit() blocks when the queue is full so that
+memory used by pending snapshots stays limited. With more than one worker thread tasks start in order but can finish
+in any order, so tasks that depend on each other (e.g. checkpoint rotation) need a single worker. Tensors passed to tasks should be snapshots (see snapshot()) since
+training continues to update the originals.
+
+Exceptions raised by tasks are printed when they happen and the first one is raised again by close().
+
+"""
+
+import queue
+import threading
+import traceback
+
+import torch
+
+
+def snapshot(x):
+    """
+    Copying tensors (to CPU) in nested dicts/lists/tuples so they aren't changed by later training steps
+    """
+    if torch.is_tensor(x):
+        x = x.detach()
+        return x.clone() if x.device.type=='cpu' else x.cpu()
+    elif isinstance(x, dict):
+        return type(x)((key, snapshot(value)) for key, value in x.items())
+    elif isinstance(x, list):
+        return [snapshot(i) for i in x]
+    elif isinstance(x, tuple):
+        return tuple(snapshot(i) for i in x)
+    else:
+        return x
+
+
+class BackgroundWriter:
+    def __init__(self,
+                 max_queue = 2,
+                 enabled = True,
+                 workers = 1):
+        """
+        Background threads running submitted tasks, tasks are run immediately on the calling thread if not enabled
+        """
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self.workers = workers
+
+        self.tasks = queue.Queue(maxsize = max_queue)
+        self.errors = []
+        self.threads = []
+
+    def __repr__(self): return f'{self.__class__.__name__}: max_queue = {self.max_queue}, enabled = {self.enabled}, workers = {self.workers}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, function, *args, **kwargs):
+        if not self.enabled:
+            function(*args, **kwargs)
+            return
+
+        if len(self.threads)==0:
+            self.threads = [threading.Thread(target = self.run, daemon = True) for i in range(self.workers)]
+            for thread in self.threads:
+                thread.start()
+
+        self.tasks.put((function, args, kwargs))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            function, args, kwargs = task
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                self.errors.append(e)
+
+    def close(self):
+        """
+        Waiting for every submitted task to finish
+        """
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if len(self.errors)>0:
+            error = self.errors[0]
+            self.errors = []
+            raise error
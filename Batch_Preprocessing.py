@@ -0,0 +1,234 @@
+"""
+
+Batched torch version of the resize_special, resize, and normalize pre_transforms
+
+Images (or patches) with the same size are stacked and preprocessed together on the model's device
+(or with vectorized operations on the CPU) instead of one at a time with numpy/skimage.
+
+Differences from the numpy pre_transforms:
+- Resizing is bilinear with antialiasing (torch) instead of skimage's gaussian anti-aliasing
+- "rgb2lab", "multi_input_mean", and dictionary color transforms are not supported
+
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.ndimage import gaussian_filter1d
+
+
+# Same weights as skimage.color.rgb2gray
+GRAY_WEIGHTS = [0.2125, 0.7154, 0.0721]
+
+
+def min_max_batch(x):
+    # Scaling each image in a batch of (N,H,W) to 0-1
+    x_min = torch.amin(x, dim = (1,2), keepdim = True)
+    x_max = torch.amax(x, dim = (1,2), keepdim = True)
+
+    return (x-x_min)/(x_max-x_min)
+
+
+def channel_sum_norm_batch(x):
+    # Dividing channels by their sum (where the sum is not zero)
+    x_sum = torch.sum(x, dim = -1, keepdim = True)
+
+    return torch.where(x_sum!=0, x/torch.where(x_sum!=0, x_sum, torch.ones_like(x_sum)), torch.zeros_like(x))
+
+
+def color_transform_batch(x, transform, integer):
+    """
+    Applying one of the resize_special color transforms to a batch of (N,H,W,C) images
+
+    integer indicates that values are still on the original integer scale (rescaled to 0-1 when resizing)
+    """
+    if transform=='multi_input_green_invbf':
+        f_img = min_max_batch(x[...,1])
+        b_img = min_max_batch(255-x[...,4])
+        return torch.stack((f_img,b_img),dim=-1), False
+
+    elif transform=='multi_input_mean_invbf':
+        f_img = min_max_batch(torch.mean(x[...,0:3],dim=-1))
+        b_img = min_max_batch(255-torch.mean(x[...,2:5],dim=-1))
+        return torch.stack((f_img,b_img),dim=-1), False
+
+    elif transform=='multi_input_green':
+        return x[...,[1,4]], integer
+
+    elif transform=='multi_input_decay':
+        x = x.clone()
+        x[...,0:3] = 0
+        return x, integer
+
+    elif transform=='multi_input_invbf':
+        # Applied after resizing (to 0-1) in resize_special
+        f_img = x[...,0:3]/torch.sum(x[...,0:3],dim=-1,keepdim=True)
+        b_img = 255-x[...,2:5]
+        b_img = b_img/torch.sum(b_img,dim=-1,keepdim=True)
+        return torch.cat((f_img,b_img),dim=-1), False
+
+    elif transform=='mean':
+        return torch.mean(x,dim=-1,keepdim=True), False
+
+    elif transform in ['red','green','blue']:
+        color_idx = ['red','green','blue'].index(transform)
+        return x[...,color_idx:color_idx+1], integer
+
+    elif transform=='rgb2gray':
+        weights = torch.tensor(GRAY_WEIGHTS, dtype = x.dtype, device = x.device)
+        return torch.sum(x[...,0:3]*weights,dim=-1,keepdim=True), integer
+
+    elif transform=='invert_bf_intensity':
+        f_img = channel_sum_norm_batch(x[...,0:3])[...,1]
+        b_img = channel_sum_norm_batch(255-x[...,2:5])[...,1]
+        return torch.stack((f_img,b_img),dim=-1), False
+
+    elif transform=='invert_bf_01norm':
+        f_img = channel_sum_norm_batch(x[...,0:3])
+        b_img = channel_sum_norm_batch(255-x[...,2:5])
+        return torch.cat((f_img,b_img),dim=-1), False
+
+    else:
+        # No color transform
+        return x, integer
+
+
+def channel_weights(n_channels):
+    # Weights matching skimage resizing a channel axis to one channel (gaussian anti-aliasing, then sampling the center)
+    sigma = (n_channels-1)/2
+    weights = gaussian_filter1d(np.eye(n_channels), sigma, axis = 0, mode = 'mirror') if sigma>0 else np.eye(n_channels)
+
+    center = (n_channels-1)/2
+    low, high = int(np.floor(center)), int(np.ceil(center))
+
+    return weights[low]*(1-(center-low))+weights[high]*(center-low)
+
+
+def resize_batch(x, output_size):
+    # Bilinear resizing of (N,H,W,C) images (antialiasing when downsampling)
+    if list(x.shape[1:3])==list(output_size[0:2]):
+        return x
+
+    downsampling = x.shape[1]>output_size[0] or x.shape[2]>output_size[1]
+    x = F.interpolate(x.permute(0,3,1,2), size = tuple(output_size[0:2]), mode = 'bilinear', align_corners = False, antialias = downsampling)
+
+    return x.permute(0,2,3,1)
+
+
+class BatchPreprocessing:
+
+    # color_transform values with a batched implementation
+    supported_transforms = ['None','mean','red','green','blue','rgb2gray','invert_bf_intensity','invert_bf_01norm',
+                            'multi_input_invbf','multi_input_green_invbf','multi_input_mean_invbf','multi_input_green','multi_input_decay']
+
+    def __init__(self,
+                 output_size: list,
+                 mask_size: list,
+                 color_transform: str,
+                 mean: list,
+                 std: list,
+                 device = None,
+                 channels_first = False):
+        """
+        Resizing, color transform, and normalization for batches of images and targets
+
+        channels_first moves the channel axis to (N,C,H,W) (same as the np.moveaxis transforms)
+        """
+        if not self.supported(color_transform):
+            raise ValueError(f'No batched implementation of color_transform: {color_transform}')
+
+        self.output_size = output_size
+        self.mask_size = mask_size
+        self.color_transform = color_transform
+        self.mean = mean
+        self.std = std
+        self.channels_first = channels_first
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+    @classmethod
+    def supported(cls, color_transform):
+        return type(color_transform)==str and color_transform in cls.supported_transforms
+
+    def __repr__(self): return f'{self.__class__.__name__}: {self.__dict__}'
+
+    def __call__(self, img, tar):
+        # Single image/target pair (same interface as ComposeDouble)
+        images, targets = self.preprocess([img], [tar])
+
+        return images[0], targets[0]
+
+    def to_tensor(self, arrays):
+        # Stacking arrays into one float32 tensor on the preprocessing device, also returning the integer scale (if any)
+        arrays = np.stack(arrays,axis=0)
+        max_value = np.iinfo(arrays.dtype).max if np.issubdtype(arrays.dtype,np.unsignedinteger) else None
+
+        # Copying to the device before converting to float
+        x = torch.from_numpy(arrays).to(self.device, non_blocking = True)
+
+        return x.float(), max_value
+
+    def transform_images(self, x, max_value = None):
+        """
+        Color transform, resizing, and normalization of a (N,H,W,C) float32 image tensor
+
+        max_value is the maximum of the original integer dtype (e.g. 255), None for float images
+        """
+        integer = max_value is not None
+        if self.color_transform=='multi_input_invbf':
+            x = resize_batch(x, self.output_size)
+            if integer:
+                x = x/max_value
+            integer = False
+
+        if self.color_transform=='rgb2gray' and integer:
+            x = x/max_value
+            integer = False
+
+        x, integer = color_transform_batch(x, self.color_transform, integer)
+        x = resize_batch(x, self.output_size)
+        if integer:
+            x = x/max_value
+
+        x = (x-torch.tensor(self.mean,dtype=x.dtype,device=x.device))/torch.tensor(self.std,dtype=x.dtype,device=x.device)
+
+        if self.channels_first:
+            x = x.permute(0,3,1,2)
+
+        return x.contiguous()
+
+    def transform_targets(self, y, max_value = None):
+        # Resizing a (N,H,W) or (N,H,W,C) target tensor to mask_size
+        if y.dim()==3:
+            y = y[...,None]
+
+        y = resize_batch(y, self.mask_size)
+        if max_value is not None:
+            y = y/max_value
+
+        # Combining channels if the target has more than mask_size
+        if len(self.mask_size)>2 and self.mask_size[2]==1 and y.shape[-1]>1:
+            weights = torch.tensor(channel_weights(y.shape[-1]),dtype=y.dtype,device=y.device)
+            y = torch.sum(y*weights,dim=-1,keepdim=True)
+        elif len(self.mask_size)>2 and not y.shape[-1]==self.mask_size[2]:
+            y = torch.mean(y,dim=-1,keepdim=True)
+
+        if self.channels_first:
+            y = y.permute(0,3,1,2)
+
+        return y.contiguous()
+
+    def preprocess(self, images, targets):
+        """
+        Preprocessing lists of same-sized images and targets, returns float32 numpy arrays
+        """
+        with torch.no_grad():
+            x, x_max = self.to_tensor(images)
+            y, y_max = self.to_tensor(targets)
+
+            x = self.transform_images(x, x_max)
+            y = self.transform_targets(y, y_max)
+
+        return x.cpu().numpy(), y.cpu().numpy()
@@ -0,0 +1,90 @@
+"""
+
+Profiling gradient accumulation and activation checkpointing at a fixed effective batch size
+
+Each configuration (micro-batch size x accumulation steps = effective batch size, with and without
+encoder activation checkpointing) runs in a separate process so that peak memory is measured independently (see Benchmark_Utils.py):
+- GPU: torch.cuda.max_memory_allocated
+- CPU: peak resident set size of the process
+
+Activation checkpointing only applies to the multimodal architecture (MultiModalModel encoders).
+
+Example:
+python Benchmark_Accumulation.py --architecture multimodal --in_channels 6 --image_size 512 --effective_batch 8
+
+"""
+
+import argparse
+
+import torch
+
+from CollagenSegUtils import get_precision, autocast, to_memory_format
+from Benchmark_Utils import build_model, random_batch, time_steps, run_isolated
+
+
+def run_config(args, batch_size, accumulation_steps, checkpoint_encoders, results):
+    # Timing optimizer steps for one configuration, run in its own process
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    parameters = {'precision': args.precision, 'channels_last': args.channels_last}
+    precision = get_precision(parameters, device)
+
+    model = to_memory_format(build_model(args, checkpoint_encoders).to(device), parameters)
+    model.train()
+    images, masks = random_batch(args, batch_size, device, parameters)
+
+    loss = torch.nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr = 1e-5)
+    grad_scaler = torch.cuda.amp.GradScaler(enabled = precision=='fp16')
+
+    def step():
+        # Same accumulation as Training_Loop
+        optimizer.zero_grad()
+        for a in range(accumulation_steps):
+            with autocast(device, precision):
+                batch_loss = loss(model(images).float(),masks)/accumulation_steps
+            grad_scaler.scale(batch_loss).backward()
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
+
+    step_time, peak_memory = time_steps(step, device, args.warmup, args.iterations)
+
+    results.put({
+        'Batch_Size': batch_size,
+        'Accumulation_Steps': accumulation_steps,
+        'Activation_Checkpointing': checkpoint_encoders,
+        'Device': device.type,
+        'Images_per_Second': batch_size*accumulation_steps/step_time,
+        'Seconds_per_Step': step_time,
+        'Peak_Memory_MB': peak_memory
+    })
+
+
+def main(args):
+
+    # Micro-batch sizes that evenly divide the effective batch size
+    batch_sizes = [i for i in args.batch_size if args.effective_batch%i==0]
+    checkpointing = [False, True] if args.architecture=='multimodal' else [False]
+
+    configs = [(args, batch_size, args.effective_batch//batch_size, checkpoint_encoders) for batch_size in batch_sizes for checkpoint_encoders in checkpointing]
+    run_isolated(run_config, configs, args.output)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Throughput and peak memory for gradient accumulation and activation checkpointing'
+    )
+
+    parser.add_argument('--architecture',type=str,default='multimodal',help='Unet++ or multimodal')
+    parser.add_argument('--encoder',type=str,default='resnet34',help='Encoder for Unet++')
+    parser.add_argument('--in_channels',type=int,default=6)
+    parser.add_argument('--image_size',type=int,default=512)
+    parser.add_argument('--effective_batch',type=int,default=8,help='Images per optimizer step')
+    parser.add_argument('--batch_size',type=int,nargs='+',default=[1,2,4,8],help='Micro-batch sizes to compare')
+    parser.add_argument('--iterations',type=int,default=5)
+    parser.add_argument('--warmup',type=int,default=1)
+    parser.add_argument('--precision',type=str,default='fp32',help='fp32, bf16, or fp16')
+    parser.add_argument('--channels_last',action='store_true')
+    parser.add_argument('--output',type=str,default=None,help='Optional csv file for the results')
+
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""
+
+Benchmarking throughput and peak memory for each precision mode and memory format
+
+Each mode runs in a separate process so that peak memory is measured independently (see Benchmark_Utils.py):
+- GPU: torch.cuda.max_memory_allocated
+- CPU: peak resident set size of the process
+
+Example:
+python Benchmark_Precision.py --architecture Unet++ --in_channels 6 --image_size 512 --batch_size 2 --train
+
+"""
+
+import argparse
+
+import torch
+
+from CollagenSegUtils import get_precision, autocast, to_memory_format
+from Benchmark_Utils import build_model, random_batch, time_steps, run_isolated
+
+
+def run_mode(args, precision, channels_last, results):
+    # Timing forward (and backward if training) passes for one mode, run in its own process
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    parameters = {'precision': precision, 'channels_last': channels_last}
+    precision = get_precision(parameters, device)
+
+    model = to_memory_format(build_model(args).to(device), parameters)
+    images, masks = random_batch(args, args.batch_size, device, parameters)
+
+    loss = torch.nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr = 1e-5)
+    grad_scaler = torch.cuda.amp.GradScaler(enabled = precision=='fp16')
+
+    def step():
+        if args.train:
+            model.train()
+            optimizer.zero_grad()
+            with autocast(device, precision):
+                batch_loss = loss(model(images).float(),masks)
+            grad_scaler.scale(batch_loss).backward()
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+        else:
+            model.eval()
+            with torch.no_grad(), autocast(device, precision):
+                model(images)
+
+    step_time, peak_memory = time_steps(step, device, args.warmup, args.iterations)
+
+    results.put({
+        'Precision': precision,
+        'Channels_Last': channels_last,
+        'Device': device.type,
+        'Images_per_Second': args.batch_size/step_time,
+        'Seconds_per_Step': step_time,
+        'Peak_Memory_MB': peak_memory
+    })
+
+
+def main(args):
+
+    configs = [(args, precision, channels_last) for precision in args.precision for channels_last in [False, True]]
+    run_isolated(run_mode, configs, args.output)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Throughput and peak memory for each precision mode and memory format'
+    )
+
+    parser.add_argument('--architecture',type=str,default='Unet++',help='Unet++ or multimodal')
+    parser.add_argument('--encoder',type=str,default='resnet34',help='Encoder for Unet++')
+    parser.add_argument('--in_channels',type=int,default=6)
+    parser.add_argument('--image_size',type=int,default=512)
+    parser.add_argument('--batch_size',type=int,default=2)
+    parser.add_argument('--iterations',type=int,default=10)
+    parser.add_argument('--warmup',type=int,default=2)
+    parser.add_argument('--precision',type=str,nargs='+',default=['fp32','bf16','fp16'],help='Precision modes to compare')
+    parser.add_argument('--train',action='store_true',help='Benchmark training steps (forward and backward) instead of inference')
+    parser.add_argument('--output',type=str,default=None,help='Optional csv file for the results')
+
+    main(parser.parse_args())
@@ -0,0 +1,106 @@
+"""
+
+Shared harness for the benchmark scripts (Benchmark_Precision.py, Benchmark_Accumulation.py)
+
+Each configuration runs in a separate (spawned) process so that peak memory is measured independently:
+- GPU: torch.cuda.max_memory_allocated
+- CPU: peak resident set size of the process
+
+"""
+
+import time
+import resource
+import multiprocessing
+
+import torch
+import pandas as pd
+import segmentation_models_pytorch as smp
+
+from CollagenSegTrain import MultiModalModel
+from CollagenSegUtils import to_memory_format
+
+
+def build_model(args, checkpoint_encoders = False):
+
+    if args.architecture=='Unet++':
+        model = smp.UnetPlusPlus(
+            encoder_name = args.encoder,
+            encoder_weights = None,
+            in_channels = args.in_channels,
+            classes = 1,
+            activation = 'sigmoid'
+        )
+    elif args.architecture=='multimodal':
+        model = MultiModalModel(
+            in_channels = args.in_channels,
+            active = 'sigmoid',
+            n_classes = 1,
+            checkpoint_encoders = checkpoint_encoders
+        )
+
+    return model
+
+
+def random_batch(args, batch_size, device, parameters):
+    # Random images (in the memory format from parameters) and masks
+    images = to_memory_format(torch.randn(batch_size,args.in_channels,args.image_size,args.image_size,device=device), parameters)
+    masks = torch.rand(batch_size,1,args.image_size,args.image_size,device=device)
+
+    return images, masks
+
+
+def time_steps(step, device, warmup, iterations):
+    """
+    Running step() "warmup" times, then timing "iterations" calls, returns (seconds per step, peak memory in MB)
+    """
+    # Warm-up (also initializes lazy layers)
+    for i in range(warmup):
+        step()
+
+    if device.type=='cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        step()
+    if device.type=='cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter()-start
+
+    if device.type=='cuda':
+        peak_memory = torch.cuda.max_memory_allocated()/(1024**2)
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+    return elapsed/iterations, peak_memory
+
+
+def run_isolated(target, configs, output = None):
+    """
+    Running target(*config, results) in its own process for each config, target puts one row (dict) in results
+
+    Returns the rows as a DataFrame (also printed and optionally saved to output)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+
+    rows = []
+    for config in configs:
+        process = context.Process(target = target, args = (*config, results))
+        process.start()
+        process.join()
+
+        if process.exitcode==0:
+            rows.append(results.get())
+        else:
+            print(f'Failed: {config[1:]}')
+
+    results_df = pd.DataFrame.from_records(rows)
+    print(results_df.to_string(index = False))
+
+    if output is not None:
+        results_df.to_csv(output)
+
+    return results_df
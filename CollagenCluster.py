@@ -24,6 +24,8 @@ import umap
 
 import segmentation_models_pytorch as smp
 
+from CollagenSegUtils import get_precision, autocast, to_memory_format
+
 
 class Clusterer:
     def __init__(self,
@@ -109,9 +111,13 @@ class Clusterer:
         self.model.to(self.device)
         self.model.eval()
 
+        # Mixed precision ("precision") and memory format ("channels_last")
+        self.precision = get_precision(self.parameters, self.device)
+        self.model = to_memory_format(self.model, self.parameters)
+
     def extract_feature_loop(self,dataset):
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(self.device, self.precision):
 
             test_dataloader = DataLoader(dataset)
             print(f'length of dataset: {len(dataset)}')
@@ -119,12 +125,12 @@ class Clusterer:
             all_features = None
 
             data_iterator = iter(test_dataloader)
-            with tqdm(range(len(dataset.images)),desc='Extracting Features') as pbar:
-                for i in range(0,len(dataset.images)):
+            with tqdm(range(len(dataset.cached_item_names)),desc='Extracting Features') as pbar:
+                for i in range(0,len(dataset.cached_item_names)):
                     
                     if dataset.patch_batch:
 
-                        n_patches = len(dataset.cached_data[i])
+                        n_patches = dataset.cached_item_patches[i]
                         image_name = dataset.cached_item_names[i]
 
                         for n in range(0,n_patches):
@@ -132,8 +138,8 @@ class Clusterer:
                             image, _, input_name = next(data_iterator)
                             input_name = ''.join(input_name).split(os.sep)[-1]
 
-                            feature_maps = self.model.encoder(image.to(self.device))[-1]
-                            features = self.feature_post_extract(feature_maps)
+                            feature_maps = self.model.encoder(to_memory_format(image.to(self.device),self.parameters))[-1]
+                            features = self.feature_post_extract(feature_maps).float()
 
                             if all_features is None:
                                 all_features = features.cpu().numpy()
@@ -153,8 +159,8 @@ class Clusterer:
                             
                         input_name = ''.join(input_name).split(os.sep)[-1]
                         
-                        feature_maps = self.model.encoder(image.to(self.device))[-1]
-                        features = self.feature_post_extract(feature_maps)
+                        feature_maps = self.model.encoder(to_memory_format(image.to(self.device),self.parameters))[-1]
+                        features = self.feature_post_extract(feature_maps).float()
 
                         if all_features is None:
                             all_features = features.cpu().numpy()
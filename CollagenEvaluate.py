@@ -20,8 +20,8 @@ import sys
 import numpy as np
 import pandas as pd
 
-from PIL import Image
-from skimage.io import imread
+from Image_IO import read_image
+from Output_Writer import PREDICTION_EXTENSIONS
 
 import argparse
 
@@ -53,12 +53,13 @@ def main(args):
 
     
     model_name = args.test_model_path.split(os.sep)[-1]
+    test_output_dir = f'{args.test_model_path}/Testing_Output/'
 
     # Checking whether train_test_names is provided
     if args.train_test_names is None:
 
-        # Checking contents of Testing_Output/ directory
-        test_names = os.listdir(f'{args.test_model_path}/Testing_Output/')
+        # Checking contents of Testing_Output/ directory (predictions written with any "output_format")
+        test_names = [i for i in os.listdir(test_output_dir) if os.path.splitext(i)[-1] in PREDICTION_EXTENSIONS]
 
     else:
 
@@ -68,8 +69,9 @@ def main(args):
         # Getting the "Test" image names
         test_names = train_test_df[train_test_df['Phase'].str.match('Test')]['Image_Names'].tolist()
         
-        # Formatting for test outputs
-        test_names = ['Test_Example_'+t.replace('.jpg','.tif') for t in test_names]
+        # Formatting for test outputs, using the extension of the "output_format" the predictions were written with
+        test_names = ['Test_Example_'+os.path.splitext(t)[0] for t in test_names]
+        test_names = [next((t+ext for ext in PREDICTION_EXTENSIONS if os.path.exists(test_output_dir+t+ext)),t+'.tif') for t in test_names]
 
 
     print(f'Found: {len(test_names)} images for metrics calculation')
@@ -94,17 +96,17 @@ def main(args):
 
         for t_idx,t in enumerate(test_names):
             # Adjusting the test name to match the original image format (adjust as needed)
-            adjusted_name = t.replace('Test_Example_','').replace('_prediction','').replace('.tif','.jpg')
+            adjusted_name = os.path.splitext(t.replace('Test_Example_','').replace('_prediction',''))[0]+'.jpg'
             if adjusted_name in gt_names:
 
-                test_image = (1/255)*np.array(Image.open(f'{args.test_model_path}/Testing_Output/{t}'))
+                test_image = (1/255)*read_image(test_output_dir+t)
                 #print(f'test output image unique values: {np.unique(test_image).tolist()}')
                 binary_test_image = test_image.copy()
                 binary_test_image[binary_test_image>=0.1] = 1
                 binary_test_image[binary_test_image<0.1] = 0
                 binary_test_image = np.uint8(binary_test_image)
 
-                gt_image = (1/255)*np.array(Image.open(f'{args.label_path}/{adjusted_name}'))[:,:,0]
+                gt_image = (1/255)*read_image(f'{args.label_path}/{adjusted_name}')[:,:,0]
                 #print(f'gt image unique values: {np.unique(gt_image).tolist()}')
                 binary_gt_image = gt_image.copy()
                 binary_gt_image[binary_gt_image>=0.1] = 1
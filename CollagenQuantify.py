@@ -43,6 +43,9 @@ import plotly.graph_objects as go
 from skimage.transform import resize
 import json
 
+from Image_IO import read_image
+from Output_Writer import PREDICTION_EXTENSIONS
+
 class Quantifier:
     def __init__(self,
                  bf_image_dir:str,
@@ -62,9 +65,9 @@ class Quantifier:
 
         if not self.use_stitched:
             # Getting predicted image patches from self.image_dir
-            # Should all have .tif extension
-            self.mask_paths = sorted(glob(self.mask_dir+'*.tif'))
-            self.f_image_paths = [i.replace(self.mask_dir,self.f_image_dir).replace('Test_Example_','').replace('_prediction','').replace('.tif','.jpg') for i in self.mask_paths]
+            # Should all have .tif extension (or another "output_format" extension: .png, .npy)
+            self.mask_paths = sorted([i for ext in PREDICTION_EXTENSIONS for i in glob(self.mask_dir+'*'+ext)])
+            self.f_image_paths = [os.path.splitext(i.replace(self.mask_dir,self.f_image_dir).replace('Test_Example_','').replace('_prediction',''))[0]+'.jpg' for i in self.mask_paths]
             self.bf_image_paths = [i.replace(self.f_image_dir,self.bf_image_dir) for i in self.f_image_paths]
             print(f'--------------On: {self.output_dir.split("/")[-3]} -------------------------')
             print(f'------------------Found: {len(self.mask_paths)} Images!---------------------')
@@ -81,13 +84,13 @@ class Quantifier:
                 for img_idx,img in tqdm(enumerate(self.mask_paths),total = len(self.mask_paths)):
 
                     # Reading the image:
-                    og_pred_image = np.array(Image.open(img))
+                    og_pred_image = read_image(img)
                     bin_image = self.binarize(og_pred_image)
 
                     if np.sum(bin_image)>0:
 
-                        bf_image = np.mean(255-np.array(Image.open(self.bf_image_paths[img_idx])),axis=-1)
-                        f_image = np.mean(np.array(Image.open(self.f_image_paths[img_idx])),axis=-1)
+                        bf_image = np.mean(255-read_image(self.bf_image_paths[img_idx]),axis=-1)
+                        f_image = np.mean(read_image(self.f_image_paths[img_idx]),axis=-1)
 
                         # Verifying image name alignment
                         #print(f'Prediction name: {img.split(os.sep)[-1]}')
@@ -334,7 +337,7 @@ class Quantifier:
         """
         Getting Y and X coordinates from patch names for reconstruction
         """
-        coords = patch_name.split('.sci ')[-1].replace('_prediction.tif','')
+        coords = os.path.splitext(patch_name.split('.sci ')[-1])[0].replace('_prediction','')
         try:
             x_coord = int(float(coords.split(' ')[-1].replace('X','').lstrip('0')))
         except ValueError:
@@ -354,8 +357,11 @@ class Quantifier:
 
         # First going through the mask directory and pulling out the patches that contain predictions
         checked_names = []
-        for p in os.listdir(self.mask_dir):
-            patch_img = np.array(Image.open(self.mask_dir+p))
+        for p in sorted(os.listdir(self.mask_dir)):
+            if not os.path.splitext(p)[-1] in PREDICTION_EXTENSIONS:
+                continue
+
+            patch_img = read_image(self.mask_dir+p)
             patch_shape = np.shape(patch_img)
 
             if np.sum(patch_img)>0:
@@ -393,7 +399,7 @@ class Quantifier:
                 
                 pbar.set_description(f'Working on patch: {name}')
 
-                checked_patch = np.array(Image.open(self.mask_dir+name))[0:-(patch_overlap+1),0:-(patch_overlap+1)]
+                checked_patch = read_image(self.mask_dir+name)[0:-(patch_overlap+1),0:-(patch_overlap+1)]
                 resized_patch = resize(checked_patch,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample)])
 
                 # Where should this patch go?
@@ -402,9 +408,16 @@ class Quantifier:
 
                 stitched_downsampled_mask[y_start:int(y_start+resized_patch.shape[0]),x_start:int(x_start+resized_patch.shape[1])] += np.uint8(255*resized_patch)
                 
-                checked_bf = np.array(Image.open(self.bf_image_dir+name.replace('_prediction.tif','.jpg')))[0:-(patch_overlap+1),0:-(patch_overlap+1),:]
+                # Decoding inputs at reduced resolution, overlap is scaled to the decoded size
+                # Input image names are the prediction names without "_prediction" and with the .jpg extension
+                image_name = os.path.splitext(name)[0].replace('_prediction','')+'.jpg'
+                checked_bf = read_image(self.bf_image_dir+image_name,downsample = downsample)
+                bf_overlap = int(round((patch_overlap+1)*checked_bf.shape[0]/patch_shape[0]))
+                checked_bf = checked_bf[0:-bf_overlap,0:-bf_overlap,:]
                 resized_bf = resize(checked_bf,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample),3])
-                checked_f = np.array(Image.open(self.f_image_dir+name.replace('_prediction.tif','.jpg')))[0:-(patch_overlap+1),0:-(patch_overlap+1),:]
+                checked_f = read_image(self.f_image_dir+image_name,downsample = downsample)
+                f_overlap = int(round((patch_overlap+1)*checked_f.shape[0]/patch_shape[0]))
+                checked_f = checked_f[0:-f_overlap,0:-f_overlap,:]
                 resized_f = resize(checked_f,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample),3])
 
                 stitched_downsampled_bf[y_start:int(y_start+resized_patch.shape[0]),x_start:int(x_start+resized_patch.shape[1]),:] += np.uint8(255*resized_bf)
@@ -26,18 +26,12 @@ import neptune
 from Input_Pipeline import *
 from CollagenSegTrain import Training_Loop
 from CollagenSegTest import Test_Network
+from Pipelined_Inference import run_pipelined_inference
+from Output_Writer import PREDICTION_EXTENSIONS
 from CollagenCluster import Clusterer
-
-# Class to use if no neptune information is provided without having to add logic every time nept_run is called
-class FakeNeptune:
-    def __init__(self):
-        pass
-    def assign(self):
-        pass
-    def log(self):
-        pass
-    def upload(self):
-        pass
+from CollagenSegUtils import load_normalization, FakeNeptune
+from KFold_Scheduler import run_k_folds
+from Distributed import init_distributed, is_main_process, cleanup_distributed
 
 def check_image_bytes(image_path_list,lower_threshold = None, upper_threshold = None):
     # Checking if a path contains an image with greater than a set threshold of bytes
@@ -69,8 +63,9 @@ def check_duplicate(image_path_list,output_path):
 
     passed_list = []
     for i in image_path_list:
-        image_name = i.split(os.sep)[-1]
-        if not os.path.exists(output_path+f"Testing_Output/{image_name.replace('.jpg','_prediction.tif')}"):
+        # Predictions can have any "output_format" extension
+        image_name = os.path.splitext(i.split(os.sep)[-1])[0]
+        if not any([os.path.exists(output_path+f"Testing_Output/{image_name}_prediction{ext}") for ext in PREDICTION_EXTENSIONS]):
             passed_list.append(i)
     
     return passed_list
@@ -85,7 +80,11 @@ def main():
     # Getting input parameters and neptune-specific parameters (if specified)
     input_parameters = parameters['input_parameters']
 
-    if 'neptune' in input_parameters:
+    # Distributed data-parallel training ("distributed" in train_parameters) when launched with torchrun or srun
+    if input_parameters['phase'] in ['train','retrain']:
+        init_distributed(parameters['train_parameters'])
+
+    if 'neptune' in input_parameters and is_main_process():
         nept_params = input_parameters['neptune']
 
         nept_api_token = os.environ.get('NEPTUNE_API_TOKEN')
@@ -147,7 +146,12 @@ def main():
                 image_paths = sorted(pd.read_csv(input_parameters['image_dir'][input_image_type[0]])['Paths'].tolist())
 
         # Now determining which images are used for training and which are used for testing
-        if 'k_folds' in training_parameters['train_test_split']:
+        if 'k_folds' in training_parameters['train_test_split'] and 'fold_workers' in training_parameters:
+
+            # Running folds concurrently from one shared preprocessing cache
+            run_k_folds(image_paths,label_paths,training_parameters,nept_run)
+
+        elif 'k_folds' in training_parameters['train_test_split']:
 
             kf = KFold(n_splits = int(training_parameters['train_test_split']['k_folds']),shuffle=True)
             k_count = 1
@@ -156,6 +160,7 @@ def main():
             for train_idx, test_idx in kf.split(image_paths):
 
                 print(f'On k-fold: {k_count}')
+                training_parameters['current_k_fold'] = k_count
 
                 train_idx = list(train_idx.astype(int))
                 test_idx = list(test_idx.astype(int))
@@ -187,7 +192,8 @@ def main():
                     nept_run=nept_run
                 )
 
-                Test_Network(model,validation_dataset,nept_run,training_parameters)
+                if is_main_process():
+                    Test_Network(model,validation_dataset,nept_run,training_parameters)
 
                 k_count+=1
 
@@ -215,7 +221,8 @@ def main():
             )
 
             model = Training_Loop(dataset_train, dataset_valid, training_parameters,nept_run)
-            Test_Network(model, dataset_valid, nept_run, training_parameters)
+            if is_main_process():
+                Test_Network(model, dataset_valid, nept_run, training_parameters)
 
         elif 'training' in training_parameters['train_test_split']:
             
@@ -260,7 +267,27 @@ def main():
 
             model = Training_Loop(dataset_train,dataset_valid,training_parameters,nept_run)
 
-            Test_Network(model,dataset_valid,nept_run,training_parameters)
+            if is_main_process():
+                Test_Network(model,dataset_valid,nept_run,training_parameters)
+
+        elif 'packed' in training_parameters['train_test_split']:
+
+            # Using packed files created with Pack_Dataset.py (paths to the .json index files)
+            packed_split = training_parameters['train_test_split']['packed']
+
+            dataset_train, dataset_valid = make_training_set(
+                'train',
+                train_img_paths = packed_split['training'],
+                train_tar = [],
+                valid_img_paths = packed_split['testing'],
+                valid_tar = [],
+                parameters = training_parameters
+            )
+
+            model = Training_Loop(dataset_train,dataset_valid,training_parameters,nept_run)
+
+            if is_main_process():
+                Test_Network(model,dataset_valid,nept_run,training_parameters)
 
     elif input_parameters['phase']=='retrain':
 
@@ -311,7 +338,12 @@ def main():
                 image_paths = sorted(pd.read_csv(image_path_in_type)['Paths'].tolist())
 
         # Now determining which images are used for training and which are used for testing
-        if 'k_folds' in training_parameters['train_test_split']:
+        if 'k_folds' in training_parameters['train_test_split'] and 'fold_workers' in training_parameters:
+
+            # Running folds concurrently from one shared preprocessing cache
+            run_k_folds(image_paths,label_paths,training_parameters,nept_run)
+
+        elif 'k_folds' in training_parameters['train_test_split']:
 
             kf = KFold(n_splits = int(training_parameters['train_test_split']['k_folds']),shuffle=True)
             k_count = 1
@@ -320,6 +352,7 @@ def main():
             for train_idx, test_idx in kf.split(image_paths):
 
                 print(f'On k-fold: {k_count}')
+                training_parameters['current_k_fold'] = k_count
 
                 train_idx = list(train_idx.astype(int))
                 test_idx = list(test_idx.astype(int))
@@ -351,7 +384,8 @@ def main():
                     nept_run=nept_run
                 )
 
-                Test_Network(model,validation_dataset,nept_run,training_parameters)
+                if is_main_process():
+                    Test_Network(model,validation_dataset,nept_run,training_parameters)
 
                 k_count+=1
 
@@ -379,7 +413,8 @@ def main():
             )
 
             model = Training_Loop(dataset_train, dataset_valid, training_parameters,nept_run)
-            Test_Network(model, dataset_valid, nept_run, training_parameters)
+            if is_main_process():
+                Test_Network(model, dataset_valid, nept_run, training_parameters)
 
         elif 'training' in training_parameters['train_test_split']:
             
@@ -424,7 +459,27 @@ def main():
 
             model = Training_Loop(dataset_train,dataset_valid,training_parameters,nept_run)
 
-            Test_Network(model,dataset_valid,nept_run,training_parameters)
+            if is_main_process():
+                Test_Network(model,dataset_valid,nept_run,training_parameters)
+
+        elif 'packed' in training_parameters['train_test_split']:
+
+            # Using packed files created with Pack_Dataset.py (paths to the .json index files)
+            packed_split = training_parameters['train_test_split']['packed']
+
+            dataset_train, dataset_valid = make_training_set(
+                'train',
+                train_img_paths = packed_split['training'],
+                train_tar = [],
+                valid_img_paths = packed_split['testing'],
+                valid_tar = [],
+                parameters = training_parameters
+            )
+
+            model = Training_Loop(dataset_train,dataset_valid,training_parameters,nept_run)
+
+            if is_main_process():
+                Test_Network(model,dataset_valid,nept_run,training_parameters)
 
     elif input_parameters['phase']=='test':
 
@@ -531,31 +586,64 @@ def main():
         input_parameters['model_details'] = model_details
         input_parameters['preprocessing'] = preprocessing
 
+        # Training set normalization saved next to the model file (if present)
+        if 'normalization_file' in input_parameters:
+            normalization_file = input_parameters['normalization_file']
+        else:
+            normalization_file = os.path.join(os.path.dirname(model_file),'Training_Normalization.json')
+        
+        if os.path.exists(normalization_file):
+            print(f'Using training normalization: {normalization_file}')
+            input_parameters['training_normalization'] = load_normalization(normalization_file)
+
+        # Packed test sets (created with Pack_Dataset.py) are memory-mapped so they are run all at once
+        if 'packed' in input_parameters:
+            image_paths = [input_parameters['packed']]
+
         # This is a hack for running on large sets of large images
-        image_set_size = 5
+        # With lazy loading only paths are stored so the whole set can be run at once
+        if ('lazy_load' in input_parameters and input_parameters['lazy_load']) or 'packed' in input_parameters:
+            image_set_size = max(len(image_paths),1)
+        else:
+            image_set_size = 5
         run_throughs = ceil(len(image_paths)/image_set_size)
 
-        for run in range(run_throughs):
+        # Preprocessing the next sets of images and saving predictions while the model runs ("pipelined_inference")
+        if 'pipelined_inference' in input_parameters and input_parameters['pipelined_inference']:
+            run_path_sets = []
+            for run in range(run_throughs):
+                run_paths = image_paths[int(run*image_set_size):min(int((run+1)*image_set_size),len(image_paths))]
+                if 'packed' in input_parameters:
+                    run_paths = run_paths[0]
+                run_path_sets.append(run_paths)
+
+            run_pipelined_inference(model_file, run_path_sets, nept_run, input_parameters)
+
+        else:
+            for run in range(run_throughs):
             
-            if not int((run+1)*image_set_size)>=len(image_paths):
-                print(f'Running on images: {int(run*image_set_size)} to {int((run+1)*image_set_size)}')
-                run_paths = image_paths[int(run*image_set_size):int((run+1)*image_set_size)]
-            else:
-                print(f'Running on images: {int(run*image_set_size)} to {len(image_paths)}')
-                run_paths = image_paths[int(run*image_set_size):len(image_paths)]
+                if not int((run+1)*image_set_size)>=len(image_paths):
+                    print(f'Running on images: {int(run*image_set_size)} to {int((run+1)*image_set_size)}')
+                    run_paths = image_paths[int(run*image_set_size):int((run+1)*image_set_size)]
+                else:
+                    print(f'Running on images: {int(run*image_set_size)} to {len(image_paths)}')
+                    run_paths = image_paths[int(run*image_set_size):len(image_paths)]
             
-            print(run_paths)
+                print(run_paths)
+
+                if 'packed' in input_parameters:
+                    run_paths = run_paths[0]
                 
-            nothin, dataset_test = make_training_set(
-                'test',
-                None,
-                None,
-                run_paths,
-                [],
-                input_parameters
-            )
+                nothin, dataset_test = make_training_set(
+                    'test',
+                    None,
+                    None,
+                    run_paths,
+                    [],
+                    input_parameters
+                )
 
-            Test_Network(model_file, dataset_test, nept_run, input_parameters)
+                Test_Network(model_file, dataset_test, nept_run, input_parameters)
 
     elif input_parameters['phase']=='cluster':
 
@@ -660,3 +748,4 @@ def main():
 
 if __name__=='__main__':
     main()
+    cleanup_distributed()
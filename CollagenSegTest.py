@@ -14,7 +14,7 @@ from: https://github.com/qubvel/segmentation_models.pytorch/blob/master/examples
 
 from typing import Type
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import segmentation_models_pytorch as smp
 
 from tqdm import tqdm
@@ -23,7 +23,6 @@ import numpy as np
 from glob import glob
 
 import matplotlib.pyplot as plt
-from PIL import Image, ImageFilter
 import pandas as pd
 
 import neptune
@@ -32,29 +31,26 @@ import umap
 import plotly.express as px
 
 from Segmentation_Metrics_Pytorch.metric import BinaryMetrics
-from CollagenSegUtils import visualize_continuous, get_metrics
+from CollagenSegUtils import visualize_continuous, get_metrics, get_precision, autocast, to_memory_format
 #from CollagenCluster import Clusterer
 from CollagenSegTrain import MultiModalModel
+from Sliding_Window import SlidingWindowInference
+from Output_Writer import OutputWriter
 from tifffile import imsave
     
         
-def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
-
+def load_model(model_path, test_parameters):
+    """
+    Loading a trained model onto the available device in eval mode
+    """
     model_details = test_parameters['model_details']
 
-    if 'scaler_means' not in model_details:
-        test_parameters['model_details']['scaler_means'] = None
-        
     encoder = model_details['encoder']
     encoder_weights = model_details['encoder_weights']
 
-    # Loading clusterer to cluster latent features
-    #clusterer = Clusterer(test_parameters)
-
     ann_classes = model_details['ann_classes']
     active = model_details['active']
     target_type = model_details['target_type']
-    output_dir = test_parameters['output_dir']
 
     if active == 'None':
         active = None
@@ -65,7 +61,6 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
         n_classes = 1
 
     in_channels = int(test_parameters['preprocessing']['image_size'].split(',')[-1])
-    output_type = 'prediction'
 
     device = torch.device('cuda') if torch.cuda.is_available() else 'cpu'
 
@@ -82,7 +77,8 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
             in_channels = in_channels,
             active = active,
             n_classes = n_classes,
-            phase = 'test'
+            phase = 'test',
+            branch_execution = test_parameters['branch_execution'] if 'branch_execution' in test_parameters else 'sequential'
         )
 
     if torch.cuda.is_available:
@@ -92,7 +88,49 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
     model.to(device)
     model.eval()
 
-    with torch.no_grad():
+    # Memory format ("channels_last")
+    model = to_memory_format(model, test_parameters)
+
+    return model
+
+
+def Test_Network(model_path, dataset_valid, nept_run, test_parameters, writer = None):
+    """
+    Predicting on dataset_valid with a model file (or a model already loaded with load_model())
+
+    Predictions are saved by writer (an OutputWriter) if one is passed, otherwise by a writer created from test_parameters
+    ("output_format", "output_dtype") that is closed before returning
+    """
+
+    model_details = test_parameters['model_details']
+
+    if 'scaler_means' not in model_details:
+        test_parameters['model_details']['scaler_means'] = None
+
+    # Loading clusterer to cluster latent features
+    #clusterer = Clusterer(test_parameters)
+
+    target_type = model_details['target_type']
+    output_dir = test_parameters['output_dir']
+
+    in_channels = int(test_parameters['preprocessing']['image_size'].split(',')[-1])
+    output_type = 'prediction'
+
+    device = torch.device('cuda') if torch.cuda.is_available() else 'cpu'
+
+    if isinstance(model_path, torch.nn.Module):
+        model = model_path
+    else:
+        model = load_model(model_path, test_parameters)
+
+    close_writer = writer is None
+    if writer is None:
+        writer = OutputWriter.from_parameters(test_parameters)
+
+    # Mixed precision ("precision")
+    precision = get_precision(test_parameters, device)
+
+    with torch.no_grad(), autocast(device, precision):
 
         test_output_dir = output_dir+'/Testing_Output/'
         if not os.path.exists(test_output_dir):
@@ -111,92 +149,79 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
         all_latent_features = None
         clustering_labels = []
 
+        # Number of patches predicted at once when patches are indexed individually
+        inference_batch_size = test_parameters['inference_batch_size'] if 'inference_batch_size' in test_parameters else 1
+
         if dataset_valid.patch_batch:
             print('Using patch prediction pipeline')
+
+            # Batched sliding-window accumulation of patch predictions (patch locations come from the dataset)
+            patch_size = [int(i) for i in test_parameters['preprocessing']['image_size'].split(',')[0:-1]]
+            engine = SlidingWindowInference(
+                model,
+                tile_size = patch_size,
+                batch_size = inference_batch_size,
+                device = device,
+                parameters = test_parameters
+            )
         else:
             print('Images are the same size as the model inputs')
 
         with tqdm(range(len(dataset_valid)),desc='Testing') as pbar:
-            for i in range(0,len(dataset_valid.images)):
+            for i in range(0,len(dataset_valid.cached_item_names)):
                 
                 # Initializing combined mask from patched predictions
                 if dataset_valid.patch_batch:
 
                     save_name = dataset_valid.cached_item_names[i].split(os.sep)[-1]
                     og_file_ext = save_name.split('.')[-1]
-                    save_name = save_name.replace('.'+og_file_ext,'_prediction.tif')
+                    save_name = save_name.replace('.'+og_file_ext,'_prediction')
 
                     # Getting original image dimensions from test_dataloader
-                    original_image, _ = dataset_valid.images[i]
-                    original_image_size = np.shape(original_image)
-                    final_pred_mask = np.zeros((original_image_size[0],original_image_size[1]))
-                    overlap_mask = np.zeros_like(final_pred_mask)
-
-                    patch_size = [int(i) for i in test_parameters['preprocessing']['image_size'].split(',')[0:-1]]
+                    original_image_size = dataset_valid.image_sizes[i]
+                    engine.start(original_image_size[0:2])
                     
                     # Now getting the number of patches needed for the current image
-                    n_patches = len(dataset_valid.cached_data[i])
+                    n_patches = dataset_valid.cached_item_patches[i]
                     image_name = dataset_valid.cached_item_names[i]
                     #print(f'image name: {image_name}')
 
-                    # Grabbing list of data at once:
-                    image_list, _, input_name_list = next(data_iterator)
-                    for image, input_name in zip(image_list, input_name_list):
-
-                        #for n in range(0,n_patches):
-
-                        #image, _, input_name = next(data_iterator)
-                        input_name = ''.join(input_name).split(os.sep)[-1]
-                        #print(f'input_name: {input_name}')
+                    if dataset_valid.flat_index:
+                        # Predicting batches of patches from this image, patch locations come from the flat patch index
+                        patch_loader = DataLoader(
+                            Subset(dataset_valid, range(dataset_valid.patch_offsets[i],dataset_valid.patch_offsets[i+1])),
+                            batch_size = inference_batch_size,
+                            shuffle = False
+                        )
+                        patch_index = dataset_valid.patch_offsets[i]
+                        for image_batch, _, _ in patch_loader:
 
-                        pred_mask = model(image.to(device))
-                        """
-                        if not test_parameters['model_details']['scaler_means'] is None:
-                            pred_latent_features = clusterer.cluster_in_loop(model,image.to(device))
+                            coords = [dataset_valid.patch_location(j)[1:] for j in range(patch_index,patch_index+image_batch.shape[0])]
+                            patch_index += image_batch.shape[0]
 
-                            if all_latent_features is None:
-                                all_latent_features = pred_latent_features.cpu().numpy()
-                                clustering_labels.append({'Full_Image_Name':image_name,'Patch_Name':input_name})
-                            else:
-                                pred_latent_features = pred_latent_features.cpu().numpy()
-                                all_latent_features = np.concatenate((all_latent_features,pred_latent_features),axis=0)
-                                clustering_labels.append({'Full_Image_Name':image_name,'Patch_Name':input_name})
+                            engine.add_batch(image_batch, coords)
+                            pbar.update(image_batch.shape[0])
 
-                        """
-                        # Detaching prediction from gradients, converting to numpy array
-                        pred_mask_img = pred_mask.detach().cpu().numpy()
+                    else:
+                        # Grabbing list of data at once:
+                        image_list, _, input_name_list = next(data_iterator)
 
                         # Getting patch locations from input_name
-                        row_start = int(input_name.split('_')[-2])
-                        col_start = int(input_name.split('_')[-1].split('.')[0])
+                        coords = []
+                        for input_name in input_name_list:
+                            input_name = ''.join(input_name).split(os.sep)[-1]
+                            coords.append((int(input_name.split('_')[-2]),int(input_name.split('_')[-1].split('.')[0])))
 
-                        """
-                        fig = visualize_continuous(
-                            images = {'Pred_Mask':pred_mask_img},
-                            output_type = 'prediction'
-                        )
-                        """
-                        
-                        # Adding to final_pred_mask and overlap_mask
-                        #final_pred_mask[row_start:row_start+patch_size[0],col_start:col_start+patch_size[1]] += (fig*255).astype(np.uint8)
-                        final_pred_mask[row_start:row_start+patch_size[0],col_start:col_start+patch_size[1]] += np.squeeze(pred_mask_img*255)
-
-                        overlap_mask[row_start:row_start+patch_size[0],col_start:col_start+patch_size[1]] += np.ones((patch_size[0],patch_size[1]))
-                        
-                        #img_fig = Image.fromarray((fig*255).astype(np.uint8))
-                        #img_fig.save(test_output_dir+input_name+'.png')
-                        pbar.update(1)
+                        engine.add_tiles(zip(image_list, coords))
+                        pbar.update(len(image_list))
 
-                    # Scaling predictions by overlap (mean pixel prediction where there is overlap)
-                    final_pred_mask = np.multiply(final_pred_mask,1/overlap_mask)
+                    # Weighted mean pixel prediction where there is overlap
+                    final_pred_mask = 255*np.squeeze(engine.finish())
 
                     final_pred_mask = 255*((final_pred_mask - np.min(final_pred_mask))/np.max(final_pred_mask))
 
-                    im = Image.fromarray((final_pred_mask).astype(np.uint8))
-                    # Smoothing image to get rid of grid lines
-                    im = im.filter(ImageFilter.SMOOTH_MORE)
-                    im.save(test_output_dir+save_name)
-                    #imsave(test_output_dir+save_name,final_pred_mask)
+                    # Tile borders are blended by the engine's weight kernel ("blending") so no smoothing is needed
+                    writer.write(final_pred_mask,test_output_dir+save_name)
 
                     # Saving overlap mask
                     #overlap_mask = (overlap_mask-np.min(overlap_mask))/(np.max(overlap_mask))
@@ -219,7 +244,7 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
                     # raw values for 2-class segmentation(not binarized output masks)
                     #pred_mask = model.predict(image.to(device))
                     image = image[None,:,:,:]
-                    pred_mask = model(image.to(device))
+                    pred_mask = model(to_memory_format(image.to(device),test_parameters)).float()
 
                     """
                     if not test_parameters['model_details']['scaler_means'] is None:
@@ -274,8 +299,7 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
                         #nept_run['testing/Testing_Output_'+input_name].upload(test_output_dir+'Test_Example_'+input_name)
                     elif output_type=='prediction':
                         
-                        im = Image.fromarray((fig*255).astype(np.uint8))
-                        im.save(test_output_dir+'Test_Example_'+input_name.replace('.jpg','.tif'))
+                        writer.write(fig*255,test_output_dir+'Test_Example_'+os.path.splitext(input_name)[0])
 
                 # Used during hyperparameter optimization to compute objective value
                 if dataset_valid.testing_metrics:
@@ -353,3 +377,6 @@ def Test_Network(model_path, dataset_valid, nept_run, test_parameters):
 
         """
 
+    # Waiting for predictions to be written
+    if close_writer:
+        writer.close()
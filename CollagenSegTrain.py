@@ -15,7 +15,10 @@ A lot of different segmentation networks are available from the 'segmentation_mo
 import torch
 import numpy as np
 import segmentation_models_pytorch as smp
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel
 
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -24,9 +27,18 @@ import pandas as pd
 from tqdm import tqdm
 import sys
 import os
-from math import pi, floor
+import random
+import json
+import hashlib
+from glob import glob
+from math import pi
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
-from CollagenSegUtils import visualize_continuous
+from CollagenSegUtils import visualize_continuous, save_normalization, get_precision, autocast, to_memory_format
+from Background_Writer import BackgroundWriter, snapshot
+from Distributed import is_distributed, is_main_process, get_world_size, all_reduce_sum, barrier
+from Training_Profiler import TrainingProfiler
 
 
 class MultiModalModel(torch.nn.Module):
@@ -35,7 +47,9 @@ class MultiModalModel(torch.nn.Module):
                  active,
                  n_classes,
                  duet_decay = False,
-                 phase = 'train'):
+                 phase = 'train',
+                 checkpoint_encoders = False,
+                 branch_execution = 'sequential'):
         super().__init__()
 
         self.in_channels = in_channels
@@ -44,14 +58,30 @@ class MultiModalModel(torch.nn.Module):
         self.duet_decay = duet_decay
         self.phase = phase
 
+        # Recomputing encoder activations during backpropagation instead of storing them (only the encoder outputs are kept)
+        self.checkpoint_encoders = checkpoint_encoders
+
+        # How the two branches are run:
+        # - "sequential": model_b then model_d
+        # - "threads": model_d runs on a worker thread while model_b runs on the calling thread. torch's intra-op thread
+        #   pool (torch.set_num_threads) is shared by the whole process, so the branches overlap on the same pool rather
+        #   than each getting its own share of the CPU threads (and share the default CUDA stream on GPU)
+        if branch_execution not in ['sequential','threads']:
+            raise ValueError(f'Unknown branch_execution: {branch_execution}')
+        self.branch_execution = branch_execution
+        self.executor = None
+
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         encoder = 'resnet34'
         encoder_weights = 'imagenet'
 
         if self.duet_decay:
-            self.decay_count = -1
+            # Training step of the current forward pass, set by the training loop
+            self.decay_step = 0
             self.decay_sigma = 500
-            self.decay_stop = 4000
+            self.decay_stop = 2000
+            # 1/(value at step 0) so that the initial value is 1
+            self.decay_scale = (self.decay_sigma*(pi**0.5))/(2**0.5)
 
         if self.active=='sigmoid':
             self.final_active = torch.nn.Sigmoid()
@@ -90,19 +120,14 @@ class MultiModalModel(torch.nn.Module):
     def update_decay(self):
         """
         Decreasing influence of DUET side of the ensemble model on final prediction as training progresses
-        """
-        self.decay_count += 1
 
-        if self.decay_count < self.decay_stop:
+        The value only depends on the training step (decay_step), so every forward pass in a step (accumulated batches and
+        validation) uses the same value
+        """
+        if self.decay_step < self.decay_stop:
             # https://en.wikipedia.org/wiki/Half-normal_distribution
-            # multiplied by decay sigma to get the initial value closer to 1
-            # since this is used both in validation and training passes
-            decay_iteration = floor(self.decay_count/2)
-            new_val = ((2**0.5)/(self.decay_sigma*(pi**0.5))) * np.exp2(-1*((decay_iteration**2)/(2*(self.decay_sigma**2))))
-
-            if self.decay_count == 0:
-                self.decay_scale = 1/new_val
-            
+            # multiplied by decay scale to get the initial value to 1
+            new_val = ((2**0.5)/(self.decay_sigma*(pi**0.5))) * np.exp2(-1*((self.decay_step**2)/(2*(self.decay_sigma**2))))
             new_val = new_val * self.decay_scale
         
         else:
@@ -111,12 +136,58 @@ class MultiModalModel(torch.nn.Module):
         return new_val
 
 
+    def encode(self, encoder, input):
+        """
+        Getting encoder features, with activation checkpointing when training
+        """
+        if self.checkpoint_encoders and self.training and torch.is_grad_enabled():
+            return checkpoint(encoder, input, use_reentrant = False)
+        
+        return encoder(input)
+
+    def run_branch(self, model, input):
+        return model.decoder(*self.encode(model.encoder, input))
+
+    def __getstate__(self):
+        # Worker threads are not copied or pickled
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
+
+    def run_threads(self, b_input, d_input):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = 1)
+
+        # Autocast and grad mode are thread-local, so they are copied to the worker thread
+        device_type = b_input.device.type
+        try:
+            autocast_enabled = torch.is_autocast_enabled(device_type)
+            autocast_dtype = torch.get_autocast_dtype(device_type)
+        except (TypeError, AttributeError):
+            # torch<2.4
+            autocast_enabled = torch.is_autocast_enabled() if device_type=='cuda' else torch.is_autocast_cpu_enabled()
+            autocast_dtype = torch.get_autocast_gpu_dtype() if device_type=='cuda' else torch.get_autocast_cpu_dtype()
+        grad_enabled = torch.is_grad_enabled()
+
+        def d_branch():
+            with torch.set_grad_enabled(grad_enabled), torch.autocast(device_type, dtype = autocast_dtype, enabled = autocast_enabled):
+                return self.run_branch(self.model_d, d_input)
+
+        d_future = self.executor.submit(d_branch)
+        b_output = self.run_branch(self.model_b, b_input)
+
+        return b_output, d_future.result()
+
     def forward(self,input):
 
         b_input = input[:,0:int(self.in_channels/2),:,:]
         d_input = input[:,int(self.in_channels/2):self.in_channels,:,:]
-        b_output = self.model_b.decoder(*self.model_b.encoder(b_input))
-        d_output = self.model_d.decoder(*self.model_d.encoder(d_input))
+
+        if self.branch_execution=='threads':
+            b_output, d_output = self.run_threads(b_input, d_input)
+        else:
+            b_output = self.run_branch(self.model_b, b_input)
+            d_output = self.run_branch(self.model_d, d_input)
 
         if not self.phase == 'test':
             if self.duet_decay:
@@ -128,6 +199,182 @@ class MultiModalModel(torch.nn.Module):
         
         return final_prediction
 
+def make_loader(dataset, batch_size, train_parameters, shuffle = True):
+    """
+    DataLoader with optional worker processes ("num_workers"), prefetching ("prefetch_factor"), and pinned memory ("pin_memory")
+
+    In distributed training each process loads a different shard of dataset
+    """
+    num_workers = train_parameters['num_workers'] if 'num_workers' in train_parameters else 0
+    pin_memory = train_parameters['pin_memory'] if 'pin_memory' in train_parameters else torch.cuda.is_available()
+
+    worker_args = {}
+    if num_workers>0:
+        # Workers are kept alive between epochs
+        worker_args['persistent_workers'] = True
+        worker_args['prefetch_factor'] = train_parameters['prefetch_factor'] if 'prefetch_factor' in train_parameters else 2
+
+    sampler = DistributedSampler(dataset, shuffle = shuffle) if is_distributed() else None
+
+    return DataLoader(dataset,
+                      batch_size = batch_size,
+                      shuffle = shuffle and sampler is None,
+                      sampler = sampler,
+                      num_workers = num_workers,
+                      pin_memory = pin_memory,
+                      **worker_args)
+
+def cycle_loader(loader):
+    """
+    Iterating through a DataLoader indefinitely, each epoch is a new shuffled pass through every sample
+    """
+    epoch = 0
+    while True:
+        # Distributed samplers are reshuffled each epoch
+        if hasattr(loader.sampler,'set_epoch'):
+            loader.sampler.set_epoch(epoch)
+
+        for batch in loader:
+            yield batch
+        epoch += 1
+
+def validate(model, loader, loss, device, non_blocking = False, precision = 'fp32', parameters = {}):
+    """
+    Sample-weighted mean loss over every batch in loader, also returns the last batch (images, masks, predictions) for example outputs
+    """
+    total_loss = 0
+    n_samples = 0
+    with torch.no_grad():
+        for val_imgs, val_masks, _ in loader:
+            val_imgs = to_memory_format(val_imgs.to(device, non_blocking = non_blocking), parameters)
+            val_masks = val_masks.to(device, non_blocking = non_blocking)
+
+            with autocast(device, precision):
+                val_preds = model(val_imgs).float()
+            total_loss += loss(val_preds,val_masks).item()*val_imgs.shape[0]
+            n_samples += val_imgs.shape[0]
+
+    # Combining each process's shard of the validation set
+    total_loss, n_samples = all_reduce_sum([total_loss, n_samples], device)
+
+    return total_loss/n_samples, (val_imgs, val_masks, val_preds)
+
+def get_rng_state():
+    # Python, numpy, and torch (CPU and CUDA) random states, numpy's state is stored as a tensor so that checkpoints only contain tensors and builtins
+    np_state = np.random.get_state()
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0],torch.from_numpy(np_state[1].astype(np.int64)),*np_state[2:]),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+
+    return rng_state
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np_state = rng_state['numpy']
+    np.random.set_state((np_state[0],np_state[1].numpy().astype(np.uint32),*np_state[2:]))
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+def save_checkpoint(state, path):
+    """
+    Saving a training checkpoint atomically (written to a temporary file which then replaces path)
+    """
+    temp_path = path+'.tmp'
+    torch.save(state, temp_path)
+    os.replace(temp_path, path)
+
+# Parameters that don't change what is trained, these can differ between a run and the run resuming it
+RUN_PARAMETERS = ['resume','keep_checkpoints','save_step','step_num','epoch_num','output_dir','current_k_fold','background_writer',
+                  'writer_queue_size','profile','profile_trace_steps','num_workers','pin_memory','prefetch_factor','fold_workers',
+                  'distributed','distributed_backend','preprocessing_cache']
+
+def checkpoint_config(train_parameters):
+    # Fingerprint of the training configuration, stored in checkpoints so that runs only resume from matching checkpoints
+    config = {key: value for key, value in train_parameters.items() if not key in RUN_PARAMETERS}
+    return hashlib.sha1(json.dumps(config, sort_keys = True, default = str).encode()).hexdigest()
+
+def find_checkpoint(checkpoint_dir):
+    # Most recent (highest step) checkpoint in checkpoint_dir, None if there aren't any
+    checkpoints = glob(os.path.join(checkpoint_dir,'Checkpoint_Step_*.pth'))
+    if len(checkpoints)==0:
+        return None
+
+    return max(checkpoints, key = lambda path: int(path.split('_')[-1].replace('.pth','')))
+
+def retained_checkpoints(checkpoint_history, keep_checkpoints):
+    """
+    The last "keep_checkpoints" checkpoints and the one with the lowest validation loss
+
+    checkpoint_history is a list of [step, validation loss] for each saved checkpoint
+    """
+    keep_steps = [step for step, _ in checkpoint_history[-keep_checkpoints:]]
+    validated = [[step, val_loss] for step, val_loss in checkpoint_history if not np.isnan(val_loss)]
+    if len(validated)>0:
+        keep_steps.append(min(validated, key = lambda x: x[1])[0])
+
+    return [[step, val_loss] for step, val_loss in checkpoint_history if step in keep_steps]
+
+def rotate_checkpoints(checkpoint_dir, checkpoint_history, keep_checkpoints):
+    # Removing checkpoints that are not retained, returns the remaining ones
+    retained = retained_checkpoints(checkpoint_history, keep_checkpoints)
+    retained_steps = [step for step, _ in retained]
+    for step, _ in checkpoint_history:
+        if step not in retained_steps and os.path.exists(os.path.join(checkpoint_dir,f'Checkpoint_Step_{step}.pth')):
+            os.remove(os.path.join(checkpoint_dir,f'Checkpoint_Step_{step}.pth'))
+
+    return retained
+
+def write_checkpoint(state, checkpoint_dir, keep_checkpoints):
+    # Saving a checkpoint then removing older ones (run on the background writer)
+    save_checkpoint(state, checkpoint_dir+f'Checkpoint_Step_{state["step"]}.pth')
+    rotate_checkpoints(checkpoint_dir, state['checkpoint_history'], keep_checkpoints)
+
+def save_example(current_img, current_gt, current_pred, step, in_channels, train_parameters, output_type, output_dir, nept_run):
+    """
+    Generating example output segmentation from one validation sample, saving it and uploading that to Neptune
+    """
+    # Un-normalizing current image
+    norm_means = train_parameters['training_normalization']['mean'].tolist()
+    norm_stds = train_parameters['training_normalization']['std'].tolist()
+
+    for idx, (m,s) in enumerate(zip(norm_means,norm_stds)):
+        current_img[idx,:,:] *= s
+        current_img[idx,:,:] += m
+
+    
+    if type(in_channels)==int:
+        if in_channels == 6:
+            current_img = np.concatenate((current_img[0:3,:,:],current_img[2:5,:,:]),axis=-2)
+        elif in_channels==4:
+            current_img = np.concatenate((np.stack((current_img[0,:,:],)*3,axis=1),current_img[0:3,:,:]),axis=-2)
+        elif in_channels==2:
+            current_img = np.concatenate((current_img[0,:,:],current_img[1,:,:]),axis=-2)
+    elif type(in_channels)==list:
+        if sum(in_channels)==6:
+            current_img = np.concatenate((current_img[0:3,:,:],current_img[2:5,:,:]),axis=-2)
+        elif sum(in_channels)==2:
+            current_img = np.concatenate((current_img[0,:,:][None,:,:],current_img[1,:,:][None,:,:]),axis=-2)
+
+
+    img_dict = {'Image':np.uint8(255*current_img), 'Pred_Mask':np.uint8(255*current_pred),'Ground_Truth':np.uint8(255*current_gt)}
+
+    fig = visualize_continuous(img_dict,output_type)
+
+    # Different process for saving comparison figures vs. only predictions
+    if output_type == 'comparison':
+        fig.savefig(output_dir+f'/Training_Epoch_{step}_Example.png')
+        nept_run[f'Example_Output_{step}'].upload(output_dir+f'/Training_Epoch_{step}_Example.png')
+    elif output_type == 'prediction':
+
+        im = Image.fromarray(fig.astype(np.uint8))
+        im.save(output_dir+f'/Training_Epoch_{step}_Example.tif')
+        nept_run[f'Example_Output_{step}'].upload(output_dir+f'/Training_Epoch_{step}_Example.tif')
+
 def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
     
     model_details = train_parameters['model_details']
@@ -145,8 +392,7 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
     output_dir = train_parameters['output_dir']
     model_dir = output_dir+'/models/'
 
-    if not os.path.exists(model_dir):
-        os.makedirs(model_dir)
+    os.makedirs(model_dir, exist_ok = True)
 
     if active=='None':
         active = None
@@ -181,6 +427,10 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
     if 'training_normalization' in train_parameters:
         nept_run['Image Means'] = ','.join([str(i) for i in train_parameters['training_normalization']['mean'].tolist()])
         nept_run['Image Stds'] = ','.join([str(i) for i in train_parameters['training_normalization']['std'].tolist()])
+
+        # Saving next to the model so that testing (or another training run) can reuse the same normalization
+        if is_main_process():
+            save_normalization(train_parameters['training_normalization'],model_dir+'Training_Normalization.json')
     
     if model_details['architecture']=='Unet++':
         model = smp.UnetPlusPlus(
@@ -194,26 +444,81 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
         model = MultiModalModel(
             in_channels = in_channels,
             active = active,
-            n_classes = n_classes
+            n_classes = n_classes,
+            checkpoint_encoders = train_parameters['activation_checkpointing'] if 'activation_checkpointing' in train_parameters else False,
+            branch_execution = train_parameters['branch_execution'] if 'branch_execution' in train_parameters else 'sequential'
             )
     
     optimizer = torch.optim.Adam([
             dict(params = model.parameters(), lr = train_parameters['lr'],weight_decay = 0.0001)
             ])
     
-    lr_plateau = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer,patience=250,verbose=True)
+    # Validation every step on one random batch, or every "validation_step" steps on a fixed set of validation samples
+    # ("validation_samples", default is the full validation set)
+    validation_step = train_parameters['validation_step'] if 'validation_step' in train_parameters else None
+
+    # Patience is kept in terms of training steps
+    lr_plateau = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer,patience=max(1,250//(validation_step if validation_step is not None else 1)),verbose=True)
 
     # Sending model to current device ('cuda','cuda:0','cuda:1',or 'cpu')
     model = model.to(device)
     loss = loss.to(device)
 
+    # Mixed precision ("precision") and memory format ("channels_last"), gradients are scaled for fp16
+    precision = get_precision(train_parameters, device)
+    model = to_memory_format(model, train_parameters)
+    grad_scaler = torch.cuda.amp.GradScaler(enabled = precision=='fp16')
+    nept_run['precision'] = precision
+
+    # Distributed data-parallel training (see Distributed.py), gradients are averaged across processes during backpropagation
+    # Only the main process saves models, checkpoints, and example outputs (Neptune logging is also only on the main process)
+    distributed = is_distributed()
+    main_process = is_main_process()
+    base_model = model
+    if distributed:
+        # Lazy layers (MultiModalModel.combine_layers) have to be initialized before DDP broadcasts the main process's weights
+        if any(torch.nn.parameter.is_lazy(p) for p in model.parameters()):
+            image_size = [int(i) for i in train_parameters['preprocessing']['image_size'].split(',')]
+            model.eval()
+            with torch.no_grad():
+                model(to_memory_format(torch.zeros((1,image_size[-1],image_size[0],image_size[1]),device = device), train_parameters))
+
+        # MultiModalModel doesn't use the segmentation heads of each branch
+        model = DistributedDataParallel(
+            model,
+            device_ids = [torch.cuda.current_device()] if device.type=='cuda' else None,
+            find_unused_parameters = isinstance(base_model, MultiModalModel)
+        )
+        nept_run['world_size'] = get_world_size()
+
     batch_size = train_parameters['batch_size']
+    # Number of batches whose gradients are accumulated for each optimizer step (effective batch size is batch_size*accumulation_steps)
+    accumulation_steps = train_parameters['accumulation_steps'] if 'accumulation_steps' in train_parameters else 1
+
+    train_loader = make_loader(dataset_train,batch_size,train_parameters)
+    if validation_step is None:
+        valid_loader = make_loader(dataset_valid,batch_size,train_parameters)
+    else:
+        # Same validation samples every time
+        if 'validation_samples' in train_parameters and train_parameters['validation_samples']<len(dataset_valid):
+            validation_set = Subset(dataset_valid,range(train_parameters['validation_samples']))
+        else:
+            validation_set = dataset_valid
+        valid_loader = make_loader(validation_set,batch_size,train_parameters,shuffle = False)
+
+    # Iterators are kept for the whole training loop instead of being recreated every step
+    train_batches = cycle_loader(train_loader)
+    valid_batches = cycle_loader(valid_loader)
+    non_blocking = train_loader.pin_memory
 
-    train_loader = DataLoader(dataset_train,batch_size=batch_size,shuffle=True)
-    valid_loader = DataLoader(dataset_valid,batch_size=batch_size,shuffle=True)
+    # Lowest validation loss so far, used to save the best model
+    best_val_loss = None
     
-    # Maximum number of epochs defined here as well as how many steps between model saves and example outputs
-    epoch_num = train_parameters['step_num']
+    # Maximum number of steps defined here (either directly or as a number of epochs) as well as how many steps between model saves and example outputs
+    if 'epoch_num' in train_parameters:
+        epoch_num = max(1,(train_parameters['epoch_num']*len(train_loader))//accumulation_steps)
+    else:
+        epoch_num = train_parameters['step_num']
     save_step = train_parameters['save_step']
 
     train_loss = 0
@@ -222,10 +527,83 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
     # Recording training and validation loss
     train_loss_list = []
     val_loss_list = []
+
+    # Full training checkpoints (model, optimizer, scheduler, gradient scaler, losses, and random states) saved every "save_step" steps
+    # The last "keep_checkpoints" are kept, as well as the one with the lowest validation loss. Each k-fold has its own directory.
+    current_fold = train_parameters['current_k_fold'] if 'current_k_fold' in train_parameters else None
+    checkpoint_dir = model_dir+'checkpoints/'
+    if current_fold is not None:
+        checkpoint_dir += f'Fold_{current_fold}/'
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    keep_checkpoints = train_parameters['keep_checkpoints'] if 'keep_checkpoints' in train_parameters else 3
+    checkpoint_history = []
+    config = checkpoint_config(train_parameters)
+
+    # Resuming is opt-in: "resume" True uses the most recent checkpoint in the output directory, or it can be a checkpoint path
+    # Checkpoints from a different fold or training configuration are not resumed
+    resume = train_parameters['resume'] if 'resume' in train_parameters else False
+    if type(resume)==str:
+        resume_path = resume
+    elif resume:
+        resume_path = find_checkpoint(checkpoint_dir)
+    else:
+        resume_path = None
+
+    state = None
+    if resume_path is not None:
+        # Loaded on the CPU (random states have to be CPU tensors), load_state_dict() moves the model and optimizer states
+        state = torch.load(resume_path, map_location = 'cpu')
+        matching = 'config' in state and state['config']==config and state['fold']==current_fold
+        if not matching and type(resume)==str:
+            raise ValueError(f'Checkpoint: {resume_path} is from a different fold or training configuration')
+        elif not matching:
+            print(f'Not resuming from: {resume_path}, it is from a different fold or training configuration')
+            state = None
+
+    start_step = 0
+    if state is not None:
+        print(f'Resuming from: {resume_path}')
+
+        base_model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_plateau.load_state_dict(state['lr_plateau'])
+        grad_scaler.load_state_dict(state['grad_scaler'])
+        for key, value in state['model_attributes'].items():
+            setattr(base_model, key, value)
+
+        train_loss_list = state['train_loss']
+        val_loss_list = state['val_loss']
+        best_val_loss = state['best_val_loss']
+        checkpoint_history = state['checkpoint_history']
+        set_rng_state(state['rng_state'])
+
+        start_step = state['step']+1
+        nept_run['resumed_from_step'] = state['step']
+
+    # Kept for the final save if there are no steps left after resuming
+    i = start_step-1
+
+    # Checkpoints, example outputs, and uploads are written on a background thread ("background_writer"), the training loop
+    # only copies tensors to the CPU. At most "writer_queue_size" snapshots are waiting to be written.
+    writer = BackgroundWriter(
+        max_queue = train_parameters['writer_queue_size'] if 'writer_queue_size' in train_parameters else 2,
+        enabled = train_parameters['background_writer'] if 'background_writer' in train_parameters else True
+    )
+
+    # Optional timing of each step ("profile"), with a torch.profiler trace of steps in "profile_trace_steps" ("start,end")
+    profiler = TrainingProfiler(
+        enabled = train_parameters['profile'] if 'profile' in train_parameters else False,
+        device = device,
+        output_dir = output_dir if main_process else None,
+        nept_run = nept_run,
+        trace_steps = [int(j) for j in str(train_parameters['profile_trace_steps']).split(',')] if 'profile_trace_steps' in train_parameters else None
+    )
     
-    with tqdm(total = epoch_num, position = 0, leave = True, file = sys.stdout) as pbar:
+    with tqdm(total = epoch_num, initial = start_step, position = 0, leave = True, file = sys.stdout, disable = not main_process) as pbar:
+
+        for i in range(start_step,epoch_num):
+            profiler.start_step(i)
 
-        for i in range(0,epoch_num):
             # Turning on dropout
             model.train()
 
@@ -237,27 +615,41 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
                 pbar.set_description(f'Epoch: {i}/{epoch_num}, Train/Val Loss: {round(train_loss,4)},{round(val_loss,4)}')
                 pbar.update(5)
         
-            # Clear existing gradients in optimizer
-            optimizer.zero_grad()
-
-            # Loading training and validation samples from dataloaders
-            if 'sub_categories_file' not in train_parameters:
-                train_imgs, train_masks, _ = next(iter(train_loader))
-            else:
-                train_imgs, train_masks, _ = next(train_loader)
-            # Sending to device
-            train_imgs = train_imgs.to(device)
-            train_masks = train_masks.to(device)
-
-            # Running predictions on training batch
-            train_preds = model(train_imgs)
-
-            # Calculating loss
-            train_loss = loss(train_preds,train_masks)
+            # DUET decay value used by every forward pass in this step
+            if 'decay_step' in vars(base_model):
+                base_model.decay_step = i
 
-            # Backpropagation
-            train_loss.backward()
-            train_loss = train_loss.item()
+            # Clear existing gradients in optimizer
+            with profiler.phase('optimizer'):
+                optimizer.zero_grad()
+
+            # Accumulating gradients (and the mean loss) over training batches
+            train_loss = 0
+            for a in range(0,accumulation_steps):
+                # Loading training samples from dataloaders
+                with profiler.phase('data'):
+                    if 'sub_categories_file' not in train_parameters:
+                        train_imgs, train_masks, _ = next(train_batches)
+                    else:
+                        train_imgs, train_masks, _ = next(train_loader)
+                # Sending to device
+                with profiler.phase('copy'):
+                    train_imgs = to_memory_format(train_imgs.to(device, non_blocking = non_blocking), train_parameters)
+                    train_masks = train_masks.to(device, non_blocking = non_blocking)
+
+                # Gradients are only averaged across processes on the last accumulated batch
+                with model.no_sync() if distributed and a<accumulation_steps-1 else nullcontext():
+                    with profiler.phase('forward'), autocast(device, precision):
+                        # Running predictions on training batch
+                        train_preds = model(train_imgs)
+
+                        # Calculating loss
+                        batch_loss = loss(train_preds.float(),train_masks)/accumulation_steps
+
+                    # Backpropagation
+                    with profiler.phase('backward'):
+                        grad_scaler.scale(batch_loss).backward()
+                train_loss += batch_loss.item()
 
             train_loss_list.append(train_loss)
 
@@ -267,27 +659,45 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
                 nept_run[f'training_loss_{train_parameters["current_k_fold"]}'].log(train_loss)
 
             # Logging decay value if there is one
-            if 'decay_val' in vars(model):
-                nept_run['DUET_decay'].log(model.decay_val)
+            if 'decay_val' in vars(base_model):
+                nept_run['DUET_decay'].log(base_model.decay_val)
 
             # Updating optimizer
-            optimizer.step()
+            with profiler.phase('optimizer'):
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
 
             # Validation (don't want it to influence gradients in network)
-            with torch.no_grad():
-                # This turns off any dropout in the network 
-                model.eval()
+            if validation_step is None:
+                with torch.no_grad(), profiler.phase('validation'):
+                    # This turns off any dropout in the network 
+                    model.eval()
+
+                    val_imgs, val_masks, _ = next(valid_batches)
+                    val_imgs = to_memory_format(val_imgs.to(device, non_blocking = non_blocking), train_parameters)
+                    val_masks = val_masks.to(device, non_blocking = non_blocking)
 
-                val_imgs, val_masks, _ = next(iter(valid_loader))
-                val_imgs = val_imgs.to(device)
-                val_masks = val_masks.to(device)
+                    # Predicting on the validation images
+                    with autocast(device, precision):
+                        val_preds = model(val_imgs).float()
+                    # Finding validation loss
+                    val_loss = loss(val_preds,val_masks)
 
-                # Predicting on the validation images
-                val_preds = model(val_imgs)
-                # Finding validation loss
-                val_loss = loss(val_preds,val_masks)
+                    # Mean across processes so that the learning rate schedule is the same for each one
+                    val_loss = all_reduce_sum([val_loss.item()], device)[0]/get_world_size()
 
-                val_loss = val_loss.item()
+                run_validation = True
+
+            elif i%validation_step==0 or i==epoch_num-1 or i==start_step:
+                with profiler.phase('validation'):
+                    model.eval()
+                    val_loss, (val_imgs, val_masks, val_preds) = validate(model, valid_loader, loss, device, non_blocking, precision, train_parameters)
+
+                run_validation = True
+            else:
+                run_validation = False
+
+            if run_validation:
                 val_loss_list.append(val_loss)
 
                 if not 'current_k_fold' in train_parameters:
@@ -295,72 +705,81 @@ def Training_Loop(dataset_train, dataset_valid, train_parameters, nept_run):
                 else:
                     nept_run[f'validation_loss_{train_parameters["current_k_fold"]}'].log(val_loss)
 
-            # Stepping the learning rate plateau with the current validation loss
-            #scheduler.step()
-            lr_plateau.step(val_loss)
+                # Stepping the learning rate plateau with the current validation loss
+                #scheduler.step()
+                lr_plateau.step(val_loss)
+
+                # Saving the model with the lowest validation loss
+                if validation_step is not None and (best_val_loss is None or val_loss<best_val_loss):
+                    best_val_loss = val_loss
+                    if main_process:
+                        writer.submit(torch.save,snapshot(base_model.state_dict()),model_dir+'Collagen_Seg_Model_Best.pth')
+            else:
+                val_loss_list.append(np.nan)
 
             # Saving model if current i is a multiple of "save_step"
             # Also generating example output segmentation and uploading that to Neptune
-            if i%save_step == 0:
-                torch.save(model.state_dict(),model_dir+f'Collagen_Seg_Model_Latest.pth')
-
-                if batch_size==1:
-                    current_img = val_imgs.cpu().numpy()
-                    current_gt = val_masks.cpu().numpy()
-                    current_pred = val_preds.cpu().numpy()
-                else:
-                    current_img = val_imgs[0].cpu().numpy()
-                    current_gt = val_masks[0].cpu().numpy()
-                    current_pred = val_preds[0].cpu().numpy()
-
-                """
-                if target_type=='binary':
-                    current_pred = current_pred.round()
-                """
-
-                # Un-normalizing current image
-                norm_means = train_parameters['training_normalization']['mean'].tolist()
-                norm_stds = train_parameters['training_normalization']['std'].tolist()
-
-                for idx, (m,s) in enumerate(zip(norm_means,norm_stds)):
-                    current_img[idx,:,:] += m
-                    current_img[idx,:,:] *= s
-
-                
-                if type(in_channels)==int:
-                    if in_channels == 6:
-                        current_img = np.concatenate((current_img[0:3,:,:],current_img[2:5,:,:]),axis=-2)
-                    elif in_channels==4:
-                        current_img = np.concatenate((np.stack((current_img[0,:,:],)*3,axis=1),current_img[0:3,:,:]),axis=-2)
-                    elif in_channels==2:
-                        current_img = np.concatenate((current_img[0,:,:],current_img[1,:,:]),axis=-2)
-                elif type(in_channels)==list:
-                    if sum(in_channels)==6:
-                        current_img = np.concatenate((current_img[0:3,:,:],current_img[2:5,:,:]),axis=-2)
-                    elif sum(in_channels)==2:
-                        current_img = np.concatenate((current_img[0,:,:][None,:,:],current_img[1,:,:][None,:,:]),axis=-2)
-
-
-                img_dict = {'Image':np.uint8(255*current_img), 'Pred_Mask':np.uint8(255*current_pred),'Ground_Truth':np.uint8(255*current_gt)}
-
-                fig = visualize_continuous(img_dict,output_type)
-
-                # Different process for saving comparison figures vs. only predictions
-                if output_type == 'comparison':
-                    fig.savefig(output_dir+f'/Training_Epoch_{i}_Example.png')
-                    nept_run[f'Example_Output_{i}'].upload(output_dir+f'/Training_Epoch_{i}_Example.png')
-                elif output_type == 'prediction':
-
-                    im = Image.fromarray(fig.astype(np.uint8))
-                    im.save(output_dir+f'/Training_Epoch_{i}_Example.tif')
-                    nept_run[f'Example_Output_{i}'].upload(output_dir+f'/Training_Epoch_{i}_Example.tif')
-
-    if not i%save_step==0:
-        torch.save(model.state_dict(),model_dir+f'Collagen_Seg_Model_Latest.pth')
-
-    loss_df = pd.DataFrame(data = {'TrainingLoss':train_loss_list,'ValidationLoss':val_loss_list})
-    loss_df.to_csv(output_dir+'/Training_Validation_Loss.csv')
-    return model_dir+f'Collagen_Seg_Model_Latest.pth'
+            if i%save_step == 0 and main_process:
+                with profiler.phase('checkpoint'):
+                    model_state = snapshot(base_model.state_dict())
+                    writer.submit(torch.save,model_state,model_dir+'Collagen_Seg_Model_Latest.pth')
+
+                    # Only validation losses from this step are used to keep the best checkpoint
+                    checkpoint_history.append([i, val_loss if run_validation else np.nan])
+                    checkpoint_state = snapshot({
+                        'step': i,
+                        'fold': current_fold,
+                        'config': config,
+                        'optimizer': optimizer.state_dict(),
+                        'lr_plateau': lr_plateau.state_dict(),
+                        'grad_scaler': grad_scaler.state_dict(),
+                        'model_attributes': {key: getattr(base_model,key) for key in ['decay_step'] if key in vars(base_model)},
+                        'train_loss': train_loss_list,
+                        'val_loss': val_loss_list,
+                        'best_val_loss': best_val_loss,
+                        'checkpoint_history': checkpoint_history,
+                        'rng_state': get_rng_state()
+                    })
+                    checkpoint_state['model'] = model_state
+                    writer.submit(write_checkpoint,checkpoint_state,checkpoint_dir,keep_checkpoints)
+                    checkpoint_history = retained_checkpoints(checkpoint_history, keep_checkpoints)
+
+                    # Copies, since the example image is un-normalized in place
+                    if batch_size==1:
+                        current_img = snapshot(val_imgs).numpy()
+                        current_gt = snapshot(val_masks).numpy()
+                        current_pred = snapshot(val_preds).numpy()
+                    else:
+                        current_img = snapshot(val_imgs[0]).numpy()
+                        current_gt = snapshot(val_masks[0]).numpy()
+                        current_pred = snapshot(val_preds[0]).numpy()
+
+                    """
+                    if target_type=='binary':
+                        current_pred = current_pred.round()
+                    """
+
+                    writer.submit(save_example,current_img,current_gt,current_pred,i,in_channels,train_parameters,output_type,output_dir,nept_run)
+
+            profiler.end_step(batch_size*accumulation_steps)
+
+    if not i%save_step==0 and main_process:
+        writer.submit(torch.save,snapshot(base_model.state_dict()),model_dir+'Collagen_Seg_Model_Latest.pth')
+
+    # Waiting for saved models before they are returned (by every process)
+    writer.close()
+    profiler.save()
+
+    if main_process:
+        loss_df = pd.DataFrame(data = {'TrainingLoss':train_loss_list,'ValidationLoss':val_loss_list})
+        loss_df.to_csv(output_dir+'/Training_Validation_Loss.csv')
+    barrier()
+
+    if validation_step is not None:
+        nept_run['best_validation_loss'] = best_val_loss
+        return model_dir+'Collagen_Seg_Model_Best.pth'
+
+    return model_dir+'Collagen_Seg_Model_Latest.pth'
 
 
 
@@ -11,6 +11,7 @@ etc.
 
 """
 
+import json
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
@@ -221,6 +222,110 @@ def get_metrics(pred_mask,ground_truth,img_name,calculator,target_type):
 
     return metrics_row
 
+class ChannelStatistics:
+    """
+    Streaming per-channel mean and variance (parallel/Welford merge of each image's statistics)
+
+    Only the running count, mean, and sum of squared differences are kept in memory
+    """
+    def __init__(self):
+
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, img):
+
+        if len(np.shape(img))==2:
+            img = np.asarray(img)[:,:,None]
+
+        pixels = np.reshape(np.asarray(img,dtype=np.float64),(-1,np.shape(img)[-1]))
+        batch_count = pixels.shape[0]
+        batch_mean = np.mean(pixels,axis=0)
+        batch_m2 = np.sum((pixels-batch_mean)**2,axis=0)
+
+        self.merge(batch_count, batch_mean, batch_m2)
+
+    def merge(self, count, mean, m2):
+        # Combining with another set of statistics (https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm)
+        if count==0:
+            return
+
+        if self.count==0:
+            self.count, self.mean, self.m2 = count, np.array(mean,dtype=np.float64), np.array(m2,dtype=np.float64)
+            return
+
+        delta = mean - self.mean
+        total = self.count + count
+
+        self.mean = self.mean + delta * (count/total)
+        self.m2 = self.m2 + m2 + (delta**2) * (self.count*count/total)
+        self.count = total
+
+    def std(self):
+        return np.sqrt(self.m2/self.count)
+
+    def normalization(self):
+        # Same format as 'training_normalization' in the parameters
+        return {'mean': np.float32(self.mean), 'std': np.float32(self.std())}
+
+
+def save_normalization(normalization, file_path):
+    # Saving training normalization values (e.g. next to the model file)
+    with open(file_path,'w') as f:
+        json.dump({'mean': [float(i) for i in normalization['mean']], 'std': [float(i) for i in normalization['std']]}, f)
+
+def load_normalization(file_path):
+    with open(file_path,'r') as f:
+        normalization = json.load(f)
+
+    return {'mean': np.float32(normalization['mean']), 'std': np.float32(normalization['std'])}
+
+def get_precision(parameters, device):
+    """
+    Precision mode from "precision" in parameters ('fp32', 'bf16', or 'fp16'), changed to what is available on the device
+    """
+    precision = parameters['precision'] if 'precision' in parameters else 'fp32'
+    device_type = torch.device(device).type
+
+    if precision=='fp16' and device_type=='cpu':
+        print('fp16 autocast is not available on CPU, using bf16')
+        precision = 'bf16'
+    elif precision=='bf16' and device_type=='cuda' and not torch.cuda.is_bf16_supported():
+        print('bf16 is not supported on this GPU, using fp16')
+        precision = 'fp16'
+
+    return precision
+
+def autocast(device, precision):
+    # Autocast context for a precision mode (disabled for fp32)
+    dtype = torch.float16 if precision=='fp16' else torch.bfloat16
+
+    return torch.autocast(device_type = torch.device(device).type, dtype = dtype, enabled = not precision=='fp32')
+
+def to_memory_format(x, parameters):
+    # Converting a model or (N,C,H,W) tensor to channels_last if "channels_last" is set in parameters
+    if 'channels_last' in parameters and parameters['channels_last']:
+        return x.to(memory_format = torch.channels_last)
+
+    return x
+
+# Class to use if no neptune information is provided without having to add logic every time nept_run is called
+# (also used by every process other than the main one in distributed training and by k-fold worker processes)
+class FakeNeptune:
+    def __init__(self):
+        pass
+    def __getitem__(self,key):
+        return self
+    def __setitem__(self,key,value):
+        pass
+    def assign(self,*args,**kwargs):
+        pass
+    def log(self,*args,**kwargs):
+        pass
+    def upload(self,*args,**kwargs):
+        pass
+
 # Function to resize and apply any condensing transform like grayscale conversion
 def resize_special(img,output_size,transform):
 
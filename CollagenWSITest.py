@@ -23,7 +23,9 @@ test_parameters = parameters['testing_parameters']
 
 testing_dataset = WSISegmentationDataSet(test_parameters['target_type'],
                                         test_parameters['batch_size'],
-                                        input_parameters['image_dir'])
+                                        input_parameters['image_dir'],
+                                        pixel_overlap = test_parameters['pixel_overlap'] if 'pixel_overlap' in test_parameters else 128,
+                                        tissue_percent = test_parameters['tissue_percent'] if 'tissue_percent' in test_parameters else 1.0)
 
 model_path = input_parameters['model_file']
 
@@ -0,0 +1,123 @@
+"""
+
+Distributed data-parallel (DDP) training helpers
+
+Processes are launched with torchrun (RANK, WORLD_SIZE, LOCAL_RANK) or srun (SLURM_PROCID, SLURM_NTASKS, SLURM_LOCALID).
+Each process uses one GPU (LOCAL_RANK) if GPUs are available, otherwise the "gloo" backend is used on CPU.
+
+Example (one node, 4 processes):
+torchrun --nproc_per_node 4 CollagenSegMain.py inputs.json
+
+Example (SLURM, one task per GPU):
+srun --ntasks-per-node 4 python CollagenSegMain.py inputs.json
+
+"""
+
+import os
+import random
+import subprocess
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def launch_environment():
+    # Rank, world size, and local rank set by torchrun or SLURM (single process otherwise)
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), int(os.environ.get('LOCAL_RANK',0))
+    elif 'SLURM_PROCID' in os.environ and 'SLURM_NTASKS' in os.environ:
+        return int(os.environ['SLURM_PROCID']), int(os.environ['SLURM_NTASKS']), int(os.environ.get('SLURM_LOCALID',0))
+
+    return 0, 1, 0
+
+
+def master_address():
+    # First node in a SLURM allocation, or this machine
+    if 'SLURM_JOB_NODELIST' in os.environ:
+        try:
+            hostnames = subprocess.run(['scontrol','show','hostnames',os.environ['SLURM_JOB_NODELIST']],capture_output = True,text = True,check = True)
+            return hostnames.stdout.split()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            pass
+
+    return '127.0.0.1'
+
+
+def init_distributed(parameters):
+    """
+    Starting the process group if "distributed" is set in parameters and more than one process was launched
+
+    "distributed_backend" overrides the default ("nccl" with GPUs, "gloo" otherwise). Every process is seeded with "seed"
+    (default 0) so that random train/test splits are the same on each rank. Returns True if training is distributed.
+    """
+    if is_distributed():
+        return True
+
+    if not ('distributed' in parameters and parameters['distributed']):
+        return False
+
+    rank, world_size, local_rank = launch_environment()
+    if world_size==1:
+        return False
+
+    if 'distributed_backend' in parameters:
+        backend = parameters['distributed_backend']
+    else:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+
+    os.environ.setdefault('MASTER_ADDR',master_address())
+    os.environ.setdefault('MASTER_PORT','29500')
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+
+    dist.init_process_group(backend = backend, rank = rank, world_size = world_size)
+
+    seed = parameters['seed'] if 'seed' in parameters else 0
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    # Only the main process (rank 0) saves files and logs to Neptune
+    return get_rank()==0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(values, device):
+    """
+    Summing a list of numbers across every process (returned unchanged if not distributed)
+    """
+    if not is_distributed():
+        return values
+
+    # NCCL only reduces GPU tensors
+    values = torch.tensor(values, dtype = torch.float64, device = device)
+    dist.all_reduce(values, op = dist.ReduceOp.SUM)
+
+    return values.tolist()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,177 @@
+"""
+
+Shared image reading with a registry of decoders
+
+Readers are registered with the file formats they handle and the first available reader in a fixed preference order is
+selected for each format (see READER_PREFERENCE, the order is not benchmarked). Images are returned with their stored dtype (e.g. uint8), no conversion to float.
+
+Reduced resolution decoding (downsample > 1):
+- PIL: JPEG draft mode (DCT scaling to 1/2, 1/4, or 1/8 during decoding)
+- cv2: JPEG reduced decoding (IMREAD_REDUCED_*)
+- Other readers/formats decode at full resolution
+
+The returned image is never more than downsample times smaller than the original, callers resize to exact sizes.
+
+"""
+
+import os
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import imageio.v2 as imageio
+except ImportError:
+    imageio = None
+
+
+# name: function(path, downsample) returning an array
+READERS = {}
+READER_FORMATS = {}
+
+# Readers in order of preference for each format (first available is used)
+# PIL is preferred for JPEG/PNG, it uses libjpeg-turbo/zlib and gives the same pixels as skimage.io.imread
+READER_PREFERENCE = {
+    '.jpg': ['pil','cv2','imageio'],
+    '.jpeg': ['pil','cv2','imageio'],
+    '.png': ['pil','cv2','imageio'],
+    '.tif': ['tifffile','pil','cv2','imageio'],
+    '.tiff': ['tifffile','pil','cv2','imageio'],
+    '.npy': ['numpy']
+}
+DEFAULT_PREFERENCE = ['pil','imageio','tifffile','cv2']
+
+JPEG_FORMATS = ['.jpg','.jpeg']
+
+
+def register_reader(name, formats, available = True):
+    # Adding a reader function to the registry (skipped if its library is not installed)
+    def decorator(function):
+        if available:
+            READERS[name] = function
+            READER_FORMATS[name] = formats
+        return function
+
+    return decorator
+
+
+def file_format(path):
+    return os.path.splitext(str(path))[-1].lower()
+
+
+def select_reader(path):
+    # First available reader in the preference order for this file format
+    ext = file_format(path)
+    preference = READER_PREFERENCE[ext] if ext in READER_PREFERENCE else DEFAULT_PREFERENCE
+    for name in preference:
+        if name in READERS and (READER_FORMATS[name] is None or ext in READER_FORMATS[name]):
+            return name
+
+    raise ValueError(f'No image reader available for: {path}')
+
+
+@register_reader('pil', None)
+def read_pil(path, downsample = 1):
+
+    with Image.open(path) as img:
+        if downsample>1 and img.format=='JPEG':
+            # Draft mode, DCT scaling to the smallest scale that is still larger than the requested size
+            img.draft(img.mode,(img.size[0]//downsample,img.size[1]//downsample))
+
+        # Palette images are expanded (same as imageio/skimage.io.imread)
+        if img.mode=='P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+        return np.array(img)
+
+
+@register_reader('cv2', JPEG_FORMATS+['.png','.tif','.tiff','.bmp'], available = cv2 is not None)
+def read_cv2(path, downsample = 1):
+
+    flags = cv2.IMREAD_UNCHANGED
+    if downsample>1 and file_format(path) in JPEG_FORMATS:
+        # Reduced decoding of JPEG files at 1/2, 1/4, or 1/8 resolution
+        scale = max([i for i in [1,2,4,8] if i<=downsample])
+        if scale>1:
+            with Image.open(path) as img:
+                grayscale = img.mode=='L'
+            flags = getattr(cv2,f'IMREAD_REDUCED_{"GRAYSCALE" if grayscale else "COLOR"}_{scale}')
+
+    img = cv2.imread(str(path), flags)
+    if img is None:
+        raise FileNotFoundError(f'Unable to read: {path}')
+
+    # BGR to RGB
+    if img.ndim==3 and img.shape[-1]==3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    elif img.ndim==3 and img.shape[-1]==4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+
+    return img
+
+
+@register_reader('tifffile', ['.tif','.tiff'], available = tifffile is not None)
+def read_tifffile(path, downsample = 1):
+    try:
+        return tifffile.imread(str(path))
+    except ValueError:
+        # Compression that tifffile can't decode without imagecodecs (e.g. LZW)
+        return read_pil(path, downsample)
+
+
+@register_reader('numpy', ['.npy'])
+def read_numpy(path, downsample = 1):
+    # Raw arrays (e.g. float16 predictions)
+    return np.load(str(path))
+
+
+@register_reader('imageio', None, available = imageio is not None)
+def read_imageio(path, downsample = 1):
+    return np.asarray(imageio.imread(str(path)))
+
+
+def read_image(path, downsample = 1, reader = None):
+    """
+    Reading an image with the selected (or first available preferred) reader
+
+    downsample allows readers to decode at a reduced resolution (up to downsample times smaller)
+    """
+    if reader is None:
+        reader = select_reader(path)
+
+    return READERS[reader](str(path), int(downsample))
+
+
+def read_image_shape(path):
+    # Getting [height, width, channels] from the file header without decoding pixel data
+    if file_format(path)=='.npy':
+        shape = np.load(str(path), mmap_mode = 'r').shape
+        return [shape[0], shape[1], shape[2] if len(shape)>2 else 1]
+
+    try:
+        with Image.open(str(path)) as img:
+            width, height = img.size
+            if img.mode=='P':
+                n_channels = 4 if 'transparency' in img.info else 3
+            else:
+                n_channels = len(img.getbands())
+
+        return [height, width, n_channels]
+
+    except UnidentifiedImageError:
+        if tifffile is None:
+            raise
+
+        with tifffile.TiffFile(str(path)) as tif:
+            shape = tif.pages[0].shape
+
+        return [shape[0], shape[1], shape[2] if len(shape)>2 else 1]
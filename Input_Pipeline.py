@@ -10,16 +10,20 @@ from: https://towardsdatascience.com/creating-and-training-a-u-net-model-with-py
 """
 
 import os
+import json
 import pandas as pd
 import numpy as np
 from math import floor, ceil
 
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from skimage.io import imread, imsave
+from skimage.io import imsave
 from glob import glob
 
 from random import sample
+from itertools import repeat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import torch
 from torch.utils.data import Dataset
@@ -29,7 +33,100 @@ import albumentations
 from skimage.transform import resize
 
 from Augmentation_Functions import *
-from CollagenSegUtils import resize_special
+from CollagenSegUtils import resize_special, ChannelStatistics, load_normalization
+from Preprocessing_Cache import PreprocessingCache
+from Batch_Preprocessing import BatchPreprocessing
+from Image_IO import read_image, read_image_shape
+
+def parallel_map(function, *iterables, workers = 1, processes = False, max_pending = None):
+    # Applying function over iterables in order, either sequentially or with a pool of threads/processes
+    # At most max_pending items (default 2*workers) are submitted at a time, so the inputs and results of a large load are
+    # not all held (and pickled for worker processes) at once
+    if workers is None or workers<=1:
+        yield from map(function, *iterables)
+        return
+
+    if processes:
+        executor = ProcessPoolExecutor(max_workers = workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers = workers)
+
+    max_pending = 2*workers if max_pending is None else max(1,max_pending)
+
+    with executor:
+        pending = deque()
+        for args in zip(*iterables):
+            pending.append(executor.submit(function, *args))
+
+            if len(pending)==max_pending:
+                yield pending.popleft().result()
+
+        while len(pending)>0:
+            yield pending.popleft().result()
+
+def preprocess_item(img, tar, coords, pre_transform, patch_size):
+    # Applying pre_transforms to a whole image or to each patch of a larger image
+    # (module-level so that it can be sent to worker processes)
+    if coords is None:
+        if pre_transform is not None:
+            img, tar = pre_transform(img, tar)
+
+        return (img, tar)
+    
+    else:
+        # Iterating through the patch coordinates and applying pre_transforms to each patch
+        item_patches = []
+        for r_s, c_s in coords:
+            new_img = img[r_s:r_s+patch_size[0], c_s:c_s+patch_size[1],:]
+            new_tar = np.zeros((np.shape(new_img)[0],np.shape(new_img)[1]))
+
+            if pre_transform is not None:
+                new_img, new_tar = pre_transform(new_img, new_tar)
+
+            item_patches.append((new_img,new_tar))
+
+        return item_patches
+
+def preprocess_batched(images, targets, item_coords, pre_transform, patch_size, batch_size = 32):
+    # Applying a BatchPreprocessing pre_transform to batches of same-sized images/patches, yields items in order
+    items = []
+    batch = []
+
+    def run_batch():
+        preprocessed_images, preprocessed_targets = pre_transform.preprocess([i[0] for i in batch],[i[1] for i in batch])
+        for (_, _, outputs), new_img, new_tar in zip(batch, preprocessed_images, preprocessed_targets):
+            outputs.append((new_img, new_tar))
+        batch.clear()
+
+    def completed_items():
+        while len(items)>0 and len(items[0][2])==items[0][1]:
+            patches, _, outputs = items.pop(0)
+            yield outputs if patches else outputs[0]
+
+    for img, tar, coords in zip(images, targets, item_coords):
+        if coords is None:
+            pairs = [(img, tar)]
+        else:
+            pairs = []
+            for r_s, c_s in coords:
+                new_img = img[r_s:r_s+patch_size[0], c_s:c_s+patch_size[1],:]
+                pairs.append((new_img, np.zeros((np.shape(new_img)[0],np.shape(new_img)[1]))))
+
+        outputs = []
+        items.append((coords is not None, len(pairs), outputs))
+        for new_img, new_tar in pairs:
+            # Images and targets in a batch have to be the same size
+            if len(batch)>0 and (len(batch)==batch_size or not np.shape(batch[0][0])==np.shape(new_img) or not np.shape(batch[0][1])==np.shape(new_tar)):
+                run_batch()
+                yield from completed_items()
+
+            batch.append((new_img, new_tar, outputs))
+
+        yield from completed_items()
+
+    if len(batch)>0:
+        run_batch()
+    yield from completed_items()
 
 # Input class with required len and getitem functions
 # in this case, the inputs and targets are lists of paths matching paths for image and segmentation ground-truth
@@ -39,6 +136,10 @@ from CollagenSegUtils import resize_special
 # target to be (batch size, height, width) with dense integer encoding for each class
 
 class SegmentationDataSet(Dataset):
+
+    # Preprocessing cache keys are based on the contents of the input files
+    use_preprocessing_cache = True
+
     def __init__(self,
                  inputs: list,
                  targets: list,
@@ -63,140 +164,194 @@ class SegmentationDataSet(Dataset):
 
         self.testing_metrics = False if len(self.targets)==0 else True
 
+        # Lazy loading only stores paths and patch coordinates, images are read in __getitem__
+        self.lazy = self.parameters['lazy_load'] if 'lazy_load' in self.parameters else False
+        self.normalization = None
+
+        # Tiling on demand keeps only the (read-only) source image for larger images, patches are sliced and preprocessed when requested
+        self.tile_on_demand = self.parameters['tile_on_demand'] if 'tile_on_demand' in self.parameters else False
+        self.source_images = {}
+
+        # Contiguous float32 buffer holding all cached images (eager loading without the preprocessing cache)
+        self.image_buffer = None
+        self.buffer_count = 0
+
+        # Persistent on-disk cache of preprocessed items (if specified)
+        if 'preprocessing_cache' in self.parameters and self.use_preprocessing_cache:
+            # Batched preprocessing results are not identical to the numpy pre_transforms so they are cached separately
+            cache_config = self.parameters['preprocessing']
+            if isinstance(pre_transform, BatchPreprocessing):
+                cache_config = dict(cache_config, batch_preprocessing = True)
+            self.cache = PreprocessingCache(self.parameters['preprocessing_cache'],cache_config)
+        else:
+            self.cache = None
+        self.cache_keys = {}
+
         # increasing dataset loading efficiency
         self.pre_transform = pre_transform
         
         self.cached_data = []
         self.cached_names = []
-        self.image_means = []
-        self.image_stds = []
+        # Streaming training set statistics, previously saved statistics can be reused with "normalization_file"
+        if self.train_val_test=='train' and 'normalization_file' in self.parameters:
+            self.statistics = None
+        else:
+            self.statistics = ChannelStatistics()
         self.images = []
         self.cached_item_names = []
         self.item_idx = -1
         self.cached_item_index = 0
 
-        image_size = [int(i) for i in self.parameters['preprocessing']['image_size'].split(',')]
+        # Paths, original sizes, and patch coordinates for each item (used by both eager and lazy loading)
+        self.item_paths = []
+        self.image_sizes = []
+        self.item_coords = []
+        self.cached_item_patches = []
+
+        self.image_size = [int(i) for i in self.parameters['preprocessing']['image_size'].split(',')]
+        self.patch_size = [self.image_size[0],self.image_size[1]]
+
+        # Patch overlap percentage and correction for downsampled (10X as opposed to 20X) data, or an explicit stride ("rows,columns")
+        self.patch_overlap = float(self.parameters['preprocessing']['patch_overlap']) if 'patch_overlap' in self.parameters['preprocessing'] else 0.25
+        self.downsample_level = float(self.parameters['preprocessing']['downsample_level']) if 'downsample_level' in self.parameters['preprocessing'] else 0.5
+        if 'patch_stride' in self.parameters['preprocessing']:
+            self.patch_stride = [int(i) for i in str(self.parameters['preprocessing']['patch_stride']).split(',')][0:2]
+        else:
+            self.patch_stride = [int(i*(1-self.patch_overlap)*self.downsample_level) for i in self.patch_size]
         
-        progressbar = tqdm(range(len(self.inputs)), desc = 'Caching')
+        # Number of threads used for reading images and processes used for preprocessing (in order)
+        self.decode_workers = self.parameters['decode_workers'] if 'decode_workers' in self.parameters else 1
+        # Image reader from Image_IO (defaults to the first available reader in its preference order for each format)
+        self.image_reader = self.parameters['image_reader'] if 'image_reader' in self.parameters else None
+        self.preprocessing_workers = self.parameters['preprocessing_workers'] if 'preprocessing_workers' in self.parameters else 1
 
         if len(self.targets)>0:
             # For a training round or testing round with ground truth labels available
-            for i, img_name, tar_name in zip(progressbar, self.inputs, self.targets):
-                try:
-                    # For multi-channel image inputs
-                    if type(img_name)==list:
-                        img1,img2,tar = imread(str(img_name[0])), imread(str(img_name[1])),imread(str(tar_name))
-                        img = np.concatenate((img1,img2),axis=-1)
-                        img_name = img_name[0]
-                    else:
-                        img, tar = imread(str(img_name)), imread(str(tar_name))
-
-                    self.images.append((img,tar))
-                    self.cached_item_names.append(img_name)
-                except FileNotFoundError:
-                    print(f'File not found: {img_name}, {tar_name}')
-        
+            target_list = self.targets
         else:
             # For just predicting on images with no ground truth provided
-            for i, img_name in zip(progressbar,self.inputs):
-                try:
-                    if type(img_name)==list:
-                        img1,img2 = imread(str(img_name[0])),imread(str(img_name[1]))
-                        img = np.concatenate((img1,img2),axis=-1)
-                        img_name = img_name[0]
-                    else:
-                        img = imread(str(img_name))
-                    
-                    tar = np.zeros((np.shape(img)[0],np.shape(img)[1],1))
-
-                    self.images.append((img,tar))
-                    self.cached_item_names.append(img_name)
-
-                except FileNotFoundError:
-                    print(f'File not found: {img_name}')
-        
-        # For images that are smaller/same size as the model's patch size then just resize as normal   
-        for (img, tar),name in tqdm(zip(self.images,self.cached_item_names),total=len(self.images),desc = 'Preprocessing Images'):     
+            target_list = [None]*len(self.inputs)
 
-            if np.shape(img)[0]<=image_size[0] and np.shape(img)[1]<=image_size[1]:
-           
-                if self.pre_transform is not None:
-                    img, tar = self.pre_transform(img, tar)
+        read_results = parallel_map(self.read_input, self.inputs, target_list, workers = self.decode_workers)
 
-                # Calculating dataset mean and standard deviation
-                img_channel_mean = np.mean(img,axis=(0,1))
-                img_channel_std = np.std(img,axis=(0,1))
+        for img_name, tar_name, read_result in tqdm(zip(self.inputs, target_list, read_results), total = len(self.inputs), desc = 'Caching'):
+            if read_result is None:
+                continue
 
-                self.image_means.append(img_channel_mean)
-                self.image_stds.append(img_channel_std)
-                
-                # Data used for training and testing
-                self.cached_data.append((img,tar))
+            img_shape, img_tar = read_result
+            if img_tar is not None:
+                self.images.append(img_tar)
+
+            self.item_paths.append((img_name,tar_name))
+
+            # For multi-channel image inputs
+            if type(img_name)==list:
+                img_name = img_name[0]
+
+            self.image_sizes.append(list(img_shape))
+            self.cached_item_names.append(img_name)
+
+        # Optionally calculating statistics on a random subset of the training set
+        if 'normalization_samples' in self.parameters and self.parameters['normalization_samples']<len(self.cached_item_names):
+            self.statistics_indices = set(sample(range(len(self.cached_item_names)),self.parameters['normalization_samples']))
+        else:
+            self.statistics_indices = None
+        
+        # Determining patch coordinates and names for each image
+        for img_shape, name in zip(self.image_sizes, self.cached_item_names):
+
+            # For images that are smaller/same size as the model's patch size then just resize as normal
+            if img_shape[0]<=self.image_size[0] and img_shape[1]<=self.image_size[1]:
+                self.item_coords.append(None)
                 self.cached_names.append(name)
-            
+                self.cached_item_patches.append(1)
             else:
+                coords = self.patch_coordinates(img_shape)
+                self.original_image_size = img_shape
+
+                self.item_coords.append(coords)
+                self.cached_names.append([name.replace(f'.{name.split(".")[-1]}',f'_{r_s}_{c_s}.{name.split(".")[-1]}') for r_s,c_s in coords])
+                self.cached_item_patches.append(len(coords))
+
+        # Flat patch index (prefix sum over patches per item) so each patch is its own item for a DataLoader
+        self.flat_index = self.parameters['flat_patch_index'] if 'flat_patch_index' in self.parameters else False
+        self.patch_offsets = np.concatenate(([0],np.cumsum(self.cached_item_patches))).astype(int)
+        self.patch_item_index = np.repeat(np.arange(len(self.cached_item_patches)),self.cached_item_patches)
+        self.patch_local_index = np.arange(self.patch_offsets[-1]) - self.patch_offsets[self.patch_item_index]
+        self.item_memo = None
+
+        # Items whose patches are read from the source image on demand
+        self.tiled_items = [self.tile_on_demand and coords is not None for coords in self.item_coords]
+
+        if not self.lazy and self.cache is None:
+            # Keeping references to the source images of tiled items
+            for item_index in np.flatnonzero(self.tiled_items):
+                img, tar = self.images[item_index]
+                img.setflags(write = False)
+                self.source_images[item_index] = (img, tar)
+
+            # Separate processes for preprocessing, the pre_transforms are mostly numpy/skimage code holding the GIL
+            # (tiled items have no patches to preprocess up front)
+            preprocess_args = [[None if tiled else i[0] for i, tiled in zip(self.images, self.tiled_items)],
+                               [None if tiled else i[1] for i, tiled in zip(self.images, self.tiled_items)],
+                               [[] if tiled else coords for coords, tiled in zip(self.item_coords, self.tiled_items)]]
+
+            if isinstance(self.pre_transform, BatchPreprocessing):
+                # Batches of images/patches are preprocessed together on the preprocessing device
+                batch_size = self.parameters['preprocessing_batch_size'] if 'preprocessing_batch_size' in self.parameters else 32
+                preprocessed_items = preprocess_batched(*preprocess_args, self.pre_transform, self.patch_size, batch_size)
+            else:
+                preprocessed_items = parallel_map(preprocess_item,
+                                                  *preprocess_args,
+                                                  repeat(self.pre_transform),
+                                                  repeat(self.patch_size),
+                                                  workers = self.preprocessing_workers,
+                                                  processes = True)
 
-                # Overlap percentage, hardcoded patch size
-                self.patch_size = [image_size[0],image_size[1]]
-                self.patch_batch = 0.25
-                # Correction for downsampled (10X as opposed to 20X) data
-                self.downsample_level = 0.5
-                stride = [int(self.patch_size[0]*(1-self.patch_batch)*self.downsample_level), int(self.patch_size[1]*(1-self.patch_batch)*self.downsample_level)]
-
-                # Calculating and storing patch coordinates for each image and reading those regions at training time :/
-                n_patches = [1+floor((np.shape(img)[0]-self.patch_size[0])/stride[0]), 1+floor((np.shape(img)[1]-self.patch_size[1])/stride[1])]
-                start_coords = [0,0]
-
-                row_starts = [int(start_coords[0]+(i*stride[0])) for i in range(0,n_patches[0])]
-                col_starts = [int(start_coords[1]+(i*stride[1])) for i in range(0,n_patches[1])]
-                row_starts.append(int(np.shape(img)[0]-self.patch_size[0]))
-                col_starts.append(int(np.shape(img)[1]-self.patch_size[1]))
-                
-                self.original_image_size = list(np.shape(img))
+            for item in tqdm(preprocessed_items,total=len(self.images),desc = 'Preprocessing Images'):     
 
-                # Iterating through the row_starts and col_starts lists and applying pre_transforms to the image
-                item_patches = []
-                patch_names = []
-                for r_s in row_starts:
-                    for c_s in col_starts:
-                        new_img = img[r_s:r_s+self.patch_size[0], c_s:c_s+self.patch_size[1],:]
-                        new_tar = np.zeros((np.shape(new_img)[0],np.shape(new_img)[1]))
+                self.cached_data.append(self.buffer_item(item))
+                self.add_statistics(self.cached_data[-1],len(self.cached_data)-1)
 
-                        if self.pre_transform is not None:
-                            new_img, new_tar = self.pre_transform(new_img, new_tar)
+            # Original images are no longer needed once the preprocessed copies are cached
+            self.images = []
 
-                        # Calculating dataset mean and standard deviation
-                        img_channel_mean = np.mean(new_img,axis=(0,1))
-                        img_channel_std = np.std(new_img,axis=(0,1))
+        elif not self.lazy:
+            # Reading preprocessed items from the cache (or preprocessing and adding them to the cache)
+            preprocessed_items = parallel_map(self.read_preprocessed, range(len(self.cached_item_names)), workers = self.preprocessing_workers)
 
-                        self.image_means.append(img_channel_mean)
-                        self.image_stds.append(img_channel_std)
+            for item in tqdm(preprocessed_items,total=len(self.cached_item_names),desc = 'Preprocessing Images'):
 
-                        item_patches.append((new_img,new_tar))
-                        patch_names.append(name.replace(f'.{name.split(".")[-1]}',f'_{r_s}_{c_s}.{name.split(".")[-1]}'))
+                self.cached_data.append(item)
+                self.add_statistics(self.cached_data[-1],len(self.cached_data)-1)
 
-                self.cached_data.append(item_patches)
-                self.cached_names.append(patch_names)
-                
-                self.cached_item_patches = [len(i) for i in self.cached_data]
+        if not self.lazy and self.train_val_test=='train' and self.statistics is not None:
+            # Statistics for tiled items are calculated from patches as they are read
+            for item_index in np.flatnonzero(self.tiled_items):
+                self.add_statistics(self.load_item(item_index),item_index)
+
+        elif self.lazy and self.train_val_test=='train' and self.statistics is not None:
+            # Calculating the dataset mean and standard deviation one item at a time
+            self.calculate_statistics(self.statistics_indices)
 
-        print(f'Cached Data: {len(self.cached_data)}')
+        print(f'Cached Data: {len(self.cached_item_names)}')
         
         # Normalizing the training data only
         if self.train_val_test=='train':
-            mean_means = np.mean(np.array(self.image_means),axis=0)
-            mean_stds = np.mean(np.array(self.image_stds),axis=0)
+            if self.statistics is None:
+                print(f'Using saved training normalization: {self.parameters["normalization_file"]}')
+                self.parameters['training_normalization'] = load_normalization(self.parameters['normalization_file'])
+            else:
+                self.parameters['training_normalization'] = self.statistics.normalization()
 
-            print(f'Mean of cached data: {mean_means}, Standard Devaition of cached data: {mean_stds}')
+            mean_means = self.parameters['training_normalization']['mean']
+            mean_stds = self.parameters['training_normalization']['std']
 
-            self.parameters['training_normalization'] = {
-                'mean': mean_means,
-                'std': mean_stds
-            }
+            print(f'Mean of cached data: {mean_means}, Standard Devaition of cached data: {mean_stds}')
 
             self.normalize_cache(mean_means, mean_stds)
         
-        elif self.train_val_test=='val':
+        elif self.train_val_test=='val' or (self.train_val_test=='test' and 'training_normalization' in self.parameters):
             
             print(f'Normalizing with training data mean and standard deviation')
 
@@ -204,20 +359,219 @@ class SegmentationDataSet(Dataset):
             stds = self.parameters['training_normalization']['std']
             self.normalize_cache(means,stds)
 
+    def read_shape(self, img_name):
+        # Getting image dimensions from the file header without decoding pixel data
+        if type(img_name)==list:
+            shapes = [self.read_shape(i) for i in img_name]
+            return [shapes[0][0],shapes[0][1],sum([i[2] for i in shapes])]
+
+        return read_image_shape(img_name)
+
+    def read_input(self, img_name, tar_name = None):
+        # Reading the full image/target pair, or just the image size if items are loaded later
+        try:
+            if self.lazy or self.cache is not None:
+                return self.read_shape(img_name), None
+            else:
+                img, tar = self.read_item(img_name, tar_name)
+                return np.shape(img), (img, tar)
+
+        except FileNotFoundError:
+            print(f'File not found: {img_name}, {tar_name}')
+            return None
+
+    def read_item(self, img_name, tar_name = None):
+        # Reading image (and target if provided) from file
+        if type(img_name)==list:
+            img = np.concatenate([read_image(i, reader = self.image_reader) for i in img_name],axis=-1)
+        else:
+            img = read_image(img_name, reader = self.image_reader)
+
+        if tar_name is not None:
+            tar = read_image(tar_name, reader = self.image_reader)
+        else:
+            tar = np.zeros((np.shape(img)[0],np.shape(img)[1],1))
+
+        return img, tar
+
+    def patch_coordinates(self, img_shape):
+
+        self.patch_batch = True
+        stride = [max(1,i) for i in self.patch_stride]
+
+        # Calculating and storing patch coordinates for each image and reading those regions at training time :/
+        n_patches = [1+floor((img_shape[0]-self.patch_size[0])/stride[0]), 1+floor((img_shape[1]-self.patch_size[1])/stride[1])]
+        start_coords = [0,0]
+
+        row_starts = [int(start_coords[0]+(i*stride[0])) for i in range(0,n_patches[0])]
+        col_starts = [int(start_coords[1]+(i*stride[1])) for i in range(0,n_patches[1])]
+        row_starts.append(int(img_shape[0]-self.patch_size[0]))
+        col_starts.append(int(img_shape[1]-self.patch_size[1]))
+
+        return [(r_s,c_s) for r_s in row_starts for c_s in col_starts]
+
+    def preprocess_item(self, img, tar, coords = None):
+        return preprocess_item(img, tar, coords, self.pre_transform, self.patch_size)
+
+    def add_statistics(self, item, item_index):
+        # Updating dataset mean and standard deviation
+        if self.train_val_test=='train' and self.statistics is not None:
+            if self.statistics_indices is None or item_index in self.statistics_indices:
+                for img, tar in (item if type(item)==list else [item]):
+                    self.statistics.update(img)
+
+    def calculate_statistics(self, item_indices = None):
+        # Streaming statistics over (a subset of) items, only one item is in memory at a time with lazy loading
+        if item_indices is None:
+            item_indices = range(len(self.cached_item_names))
+        item_indices = sorted(item_indices)
+
+        statistics = ChannelStatistics()
+        loaded_items = parallel_map(self.load_item, item_indices, workers = self.preprocessing_workers)
+        for item in tqdm(loaded_items,total=len(item_indices),desc = 'Calculating Statistics'):
+            for img, tar in (item if type(item)==list else [item]):
+                statistics.update(img)
+
+        if self.train_val_test=='train' and self.statistics is not None:
+            self.statistics = statistics
+
+        return statistics
+
+    def read_preprocessed(self, item_index):
+        # Reading and preprocessing one item, skipping both if it is already in the preprocessing cache
+        if self.tiled_items[item_index]:
+            # Patches of tiled items are read from the source image when requested
+            return []
+
+        img_name, tar_name = self.item_paths[item_index]
+        coords = self.item_coords[item_index]
+
+        if self.cache is not None:
+            if item_index not in self.cache_keys:
+                self.cache_keys[item_index] = self.cache.item_key(img_name, tar_name, coords)
+            
+            item = self.cache.load(self.cache_keys[item_index])
+            if item is not None:
+                return item
+
+        img, tar = self.read_item(img_name, tar_name)
+        item = self.preprocess_item(img, tar, coords)
+
+        if self.cache is not None:
+            self.cache.save(self.cache_keys[item_index], item)
+
+        return item
+
+    def source_item(self, item_index):
+        # Full size image and target that patches of tiled items are sliced from
+        if item_index in self.source_images:
+            return self.source_images[item_index]
+
+        img, tar = self.read_item(*self.item_paths[item_index])
+        img.setflags(write = False)
+
+        # Only the most recent source image is kept with lazy loading
+        if self.lazy:
+            self.source_images = {}
+        self.source_images[item_index] = (img, tar)
+
+        return img, tar
+
+    def load_tile(self, item_index, local_index):
+        # Slicing and preprocessing one patch of a tiled item
+        img, tar = self.source_item(item_index)
+        tile = preprocess_item(img, tar, [self.item_coords[item_index][local_index]], self.pre_transform, self.patch_size)[0]
+
+        return self.normalize_item(tile)
+
+    def load_item(self, item_index):
+        # Getting preprocessed data for one item, either from memory or from file
+        if self.tiled_items[item_index]:
+            return [self.load_tile(item_index, i) for i in range(self.cached_item_patches[item_index])]
+
+        if not self.lazy:
+            return self.normalize_item(self.cached_data[item_index])
+
+        # Keeping the most recent item so that consecutive patches of the same image are only read once
+        if self.item_memo is not None and self.item_memo[0]==item_index:
+            return self.item_memo[1]
+        
+        item = self.normalize_item(self.read_preprocessed(item_index))
+        self.item_memo = (item_index, item)
+
+        return item
+
+    def patch_location(self, index):
+        # Getting the (item index, row start, column start) of a patch in the flat patch index
+        item_index = self.patch_item_index[index]
+        coords = self.item_coords[item_index]
+        if coords is None:
+            return item_index, 0, 0
+        
+        row_start, col_start = coords[self.patch_local_index[index]]
+
+        return item_index, row_start, col_start
+
+    def load_patch(self, index):
+        # Getting one preprocessed patch and its name from the flat patch index
+        item_index = self.patch_item_index[index]
+        if self.tiled_items[item_index]:
+            local_index = self.patch_local_index[index]
+            return self.load_tile(item_index, local_index), self.cached_names[item_index][local_index]
+
+        item = self.load_item(item_index)
+
+        if type(item)==list:
+            local_index = self.patch_local_index[index]
+            return item[local_index], self.cached_names[item_index][local_index]
+        else:
+            return item, self.cached_names[item_index]
+
+    def normalize_item(self, item):
+        # Normalization fused into loading (lazy loading and preprocessing cache)
+        if self.normalization is None:
+            return item
+
+        means, stds = self.normalization
+        if type(item)==list:
+            return [((img-means)/stds,tar) for img,tar in item]
+        else:
+            return ((item[0]-means)/stds,item[1])
+
+    def buffer_item(self, item):
+        # Copying preprocessed images into one contiguous float32 buffer, cached images become views of the buffer
+        buffered = []
+        for img, tar in (item if type(item)==list else [item]):
+            if self.image_buffer is None:
+                n_buffered = sum([n for n, tiled in zip(self.cached_item_patches, self.tiled_items) if not tiled])
+                self.image_buffer = np.empty((n_buffered,)+np.shape(img),dtype=np.float32)
+
+            # Images with a different shape are kept separately
+            if np.shape(img)==self.image_buffer.shape[1:] and self.buffer_count<self.image_buffer.shape[0]:
+                self.image_buffer[self.buffer_count] = img
+                img = self.image_buffer[self.buffer_count]
+                self.buffer_count+=1
+
+            buffered.append((img,tar))
+
+        return buffered if type(item)==list else buffered[0]
 
     def __len__(self):
         
         if not self.patch_batch:
-            return len(self.cached_data)
+            return len(self.cached_item_names)
         else:
-            return sum([len(i) for i in self.cached_data])
+            return sum(self.cached_item_patches)
         
     # Getting matching input and target(label)
     def __getitem__(self,index:int):
 
-        if not self.patch_batch:
-            x, y = self.cached_data[index]
-            input_ID = self.cached_names[index]
+        if not self.patch_batch or self.flat_index:
+            if not self.patch_batch:
+                x, y = self.load_item(index)
+                input_ID = self.cached_names[index]
+            else:
+                (x, y), input_ID = self.load_patch(index)
             
             # Preprocessing steps (if there are any)
             if self.transform is not None:
@@ -231,7 +585,7 @@ class SegmentationDataSet(Dataset):
         else:
 
             # Just returning a list of all patches for this index:
-            image_patches = self.cached_data[index]
+            image_patches = self.load_item(index)
             patch_names = self.cached_names[index]
 
             x_list = []
@@ -252,32 +606,6 @@ class SegmentationDataSet(Dataset):
                 input_ID_list.append(patch_id)
 
             return x_list, y_list, input_ID_list
-
-            """
-            if self.cached_item_index == 0:
-                # if the index is equal to the number of patches - 1 then it will still work
-                if index > self.cached_item_patches[self.cached_item_index]-1:
-                    # Move to the first patch for the next item
-                    self.cached_item_index += 1
-                    # Now index = 0 again
-                    index -= self.cached_item_patches[self.cached_item_index-1]
-
-            else:
-
-                index -= sum(self.cached_item_patches[0:self.cached_item_index])
-                if index >= self.cached_item_patches[self.cached_item_index]:
-                    self.cached_item_index += 1
-                    # Sending index back to zero
-                    index -= self.cached_item_patches[self.cached_item_index-1]
-            try:
-                x, y = self.cached_data[self.cached_item_index][index]
-                input_ID = self.cached_names[self.cached_item_index][index]
-            except IndexError:
-                print(f'index: {index}')
-                print(f'self.cached_item_index: {self.cached_item_index}')
-                print(f'sum(self.cached_item_patches[0:self.cached_item_index]): {sum(self.cached_item_patches[0:self.cached_item_index+1])}')
-                print(f'self.cached_item_patches: {self.cached_item_patches}')
-            """
     
     def __iter__(self):
         
@@ -291,11 +619,91 @@ class SegmentationDataSet(Dataset):
 
     def normalize_cache(self,means,stds):
         # Applying normalization to a dataset according to a given set of means and standard deviations per channel
-        for img,tar in self.cached_data:
-            img = np.float32(img)
-            for j in range(img.shape[-1]):
-                img[:,:,j] -= means[j]
-                img[:,:,j] /= stds[j]
+        means = np.float32(means)
+        stds = np.float32(stds)
+
+        if self.lazy or self.cache is not None or self.tile_on_demand:
+            # Applied to each item as it is loaded (cache files and source images are not modified)
+            self.normalization = (means, stds)
+            # The memoized item was loaded with the previous normalization (e.g. while calculating statistics)
+            self.item_memo = None
+            return
+
+        # Broadcasting over (images, height, width, channels) in place
+        if self.image_buffer is not None:
+            self.image_buffer -= means
+            self.image_buffer /= stds
+
+        # Writing back any images that are not in the buffer
+        for item_index, item in enumerate(self.cached_data):
+            normalized = [(img,tar) if self.image_buffer is not None and img.base is self.image_buffer else (np.float32((img-means)/stds),tar) for img,tar in (item if type(item)==list else [item])]
+            self.cached_data[item_index] = normalized if type(item)==list else normalized[0]
+
+
+class PackedSegmentationDataSet(SegmentationDataSet):
+
+    # Inputs are records in a packed file rather than files on disk
+    use_preprocessing_cache = False
+
+    def __init__(self,
+                 packed_path: str,
+                 train_val_test: str,
+                 transform = None,
+                 pre_transform = None,
+                 batch_size = None,
+                 parameters = {}):
+        """
+        Reading images and targets from a single memory-mapped file created by Pack_Dataset.py
+
+        packed_path is the path to the .json index file
+        """
+
+        with open(packed_path,'r') as f:
+            index = json.load(f)
+
+        # Copy-on-write mapping, pages are shared between DataLoader workers through the OS cache
+        self.packed_data = np.memmap(os.path.join(os.path.dirname(packed_path),index['data_file']),dtype=np.uint8,mode='c')
+        self.records = {r['name']: r for r in index['records']}
+
+        inputs = [r['name'] for r in index['records']]
+        targets = inputs if all(['target' in r for r in index['records']]) else []
+
+        super().__init__(inputs = inputs,
+                         targets = targets,
+                         train_val_test = train_val_test,
+                         transform = transform,
+                         pre_transform = pre_transform,
+                         batch_size = batch_size,
+                         parameters = parameters)
+
+    def read_array(self, array_meta):
+        # Zero-copy view of one array in the packed file
+        n_bytes = int(np.prod(array_meta['shape']))*np.dtype(array_meta['dtype']).itemsize
+        array = self.packed_data[array_meta['offset']:array_meta['offset']+n_bytes]
+
+        return array.view(array_meta['dtype']).reshape(array_meta['shape'])
+
+    def read_shape(self, img_name):
+        return list(self.records[img_name]['image']['shape'])
+
+    def read_item(self, img_name, tar_name = None):
+
+        img = self.read_array(self.records[img_name]['image'])
+
+        if tar_name is not None:
+            tar = self.read_array(self.records[tar_name]['target'])
+        else:
+            tar = np.zeros((np.shape(img)[0],np.shape(img)[1],1))
+
+        return img, tar
+
+
+def build_dataset(inputs, targets, **kwargs):
+    # Packed datasets are specified with the path to the index file instead of lists of paths
+    if type(inputs)==str:
+        return PackedSegmentationDataSet(packed_path = inputs, **kwargs)
+    else:
+        return SegmentationDataSet(inputs = inputs, targets = targets, **kwargs)
 
 
 def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_tar,parameters):
@@ -313,6 +721,31 @@ def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_t
         image_means = [float(0.0) for i in range(img_size[-1])]
         image_stds = [float(1.0) for i in range(img_size[-1])]
 
+    # Optional batched torch preprocessing (on the model's device unless "preprocessing_device" is specified)
+    batch_preprocessing = False
+    if 'batch_preprocessing' in parameters and parameters['batch_preprocessing']:
+
+        # Lazy loading, tiling on demand, and the preprocessing cache preprocess one item at a time in __getitem__, which can
+        # be in forked DataLoader workers where CUDA can't be initialized, so these use the CPU
+        per_item = ('lazy_load' in parameters and parameters['lazy_load']) or ('tile_on_demand' in parameters and parameters['tile_on_demand']) or 'preprocessing_cache' in parameters
+        num_workers = parameters['num_workers'] if 'num_workers' in parameters else 0
+        if 'preprocessing_device' in parameters and not (per_item and num_workers>0):
+            preprocessing_device = parameters['preprocessing_device']
+        elif per_item:
+            preprocessing_device = 'cpu'
+        else:
+            preprocessing_device = None
+
+        if BatchPreprocessing.supported(color_transform):
+            batch_preprocessing = BatchPreprocessing(output_size = img_size,
+                                                     mask_size = mask_size,
+                                                     color_transform = color_transform,
+                                                     mean = image_means,
+                                                     std = image_stds,
+                                                     device = preprocessing_device)
+        else:
+            print(f'No batched preprocessing for color_transform: {color_transform}, using numpy pre_transforms')
+
     if phase == 'train':
 
         pre_transforms = ComposeDouble([
@@ -331,6 +764,8 @@ def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_t
                                       mean = image_means,
                                       std = image_stds)
         ])        
+        if batch_preprocessing:
+            pre_transforms = batch_preprocessing
 
         # Continuous target type augmentations
         transforms_training = ComposeDouble([
@@ -346,19 +781,19 @@ def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_t
             FunctionWrapperDouble(np.moveaxis,input=True,target=True,source=-1,destination=0)
         ])
 
-        dataset_train = SegmentationDataSet(inputs = train_img_paths,
-                                             targets = train_tar,
-                                             train_val_test= 'train',
-                                             transform = transforms_training,
-                                             pre_transform = pre_transforms,
-                                             parameters = parameters)
+        dataset_train = build_dataset(train_img_paths,
+                                      train_tar,
+                                      train_val_test= 'train',
+                                      transform = transforms_training,
+                                      pre_transform = pre_transforms,
+                                      parameters = parameters)
         
-        dataset_valid = SegmentationDataSet(inputs = valid_img_paths,
-                                             targets = valid_tar,
-                                             train_val_test= 'val',
-                                             transform = transforms_validation,
-                                             pre_transform = pre_transforms,
-                                             parameters = parameters)
+        dataset_valid = build_dataset(valid_img_paths,
+                                      valid_tar,
+                                      train_val_test= 'val',
+                                      transform = transforms_validation,
+                                      pre_transform = pre_transforms,
+                                      parameters = parameters)
         
     elif phase == 'test':
 
@@ -378,6 +813,8 @@ def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_t
                                         mean = image_means,
                                         std = image_stds)
             ])
+        if batch_preprocessing:
+            pre_transforms = batch_preprocessing
         
         transforms_testing = ComposeDouble([
                 FunctionWrapperDouble(np.moveaxis, input = True, target = True, source = -1, destination = 0),
@@ -386,12 +823,12 @@ def make_training_set(phase,train_img_paths, train_tar, valid_img_paths, valid_t
         # this is 'None' because we are just testing the network
         dataset_train = None
         
-        dataset_valid = SegmentationDataSet(inputs = valid_img_paths,
-                                            targets = valid_tar,
-                                            train_val_test='test',
-                                            transform = transforms_testing,
-                                            pre_transform = pre_transforms,
-                                            parameters = parameters)
+        dataset_valid = build_dataset(valid_img_paths,
+                                      valid_tar,
+                                      train_val_test='test',
+                                      transform = transforms_testing,
+                                      pre_transform = pre_transforms,
+                                      parameters = parameters)
 
 
     return dataset_train, dataset_valid
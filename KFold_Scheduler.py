@@ -0,0 +1,144 @@
+"""
+
+Running k-fold cross-validation folds concurrently
+
+The full image pool is decoded and preprocessed once into the on-disk preprocessing cache (memory-mapped when read),
+then each fold builds its training and validation sets from the cache in a separate process.
+
+Up to "fold_workers" folds run at the same time. With GPUs, folds are assigned to devices in turn, otherwise
+each fold gets an equal share of the CPU threads.
+
+Each fold writes to {output_dir}/Fold_{k}/ and per-fold test metrics are combined in {output_dir}/K_Fold_Metrics.csv
+
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+from sklearn.model_selection import KFold
+
+from Input_Pipeline import make_training_set
+from CollagenSegTrain import Training_Loop
+from CollagenSegTest import Test_Network
+from CollagenSegUtils import FakeNeptune
+
+
+def warm_cache(image_paths, label_paths, parameters):
+    # Reading and preprocessing every image once (not normalized, that is done per fold with the fold's training statistics)
+    cache_parameters = {key: value for key, value in parameters.items() if not key=='training_normalization'}
+
+    # Lazy loading and tiling on demand skip preprocessing when the dataset is built, which would leave the cache empty
+    cache_parameters['lazy_load'] = False
+    cache_parameters['tile_on_demand'] = False
+    make_training_set('test',[],[],image_paths,label_paths,cache_parameters)
+
+
+def run_fold(k_count, train_images, train_labels, test_images, test_labels, parameters, device_index, n_threads):
+    """
+    Training and testing one fold (run in a separate process), returns the path to the trained model
+    """
+    if device_index is not None:
+        torch.cuda.set_device(device_index)
+    torch.set_num_threads(n_threads)
+
+    # Neptune runs can't be shared between processes, results are uploaded by the main process
+    nept_run = FakeNeptune()
+
+    train_dataset, validation_dataset = make_training_set(
+        phase = 'train',
+        train_img_paths = train_images,
+        train_tar = train_labels,
+        valid_img_paths = test_images,
+        valid_tar = test_labels,
+        parameters = parameters
+    )
+
+    model = Training_Loop(
+        dataset_train = train_dataset,
+        dataset_valid = validation_dataset,
+        train_parameters = parameters,
+        nept_run = nept_run
+    )
+
+    Test_Network(model,validation_dataset,nept_run,parameters)
+
+    return model
+
+
+def run_k_folds(image_paths, label_paths, training_parameters, nept_run):
+    """
+    Training and testing each fold of k-fold cross-validation with up to "fold_workers" folds at a time
+    """
+    output_dir = training_parameters['output_dir']
+    fold_workers = int(training_parameters['fold_workers'])
+
+    # Every fold reads from the same cache
+    if not 'preprocessing_cache' in training_parameters:
+        training_parameters['preprocessing_cache'] = os.path.join(output_dir,'Preprocessing_Cache')
+
+    print('Preprocessing the full image pool')
+    warm_cache(image_paths, label_paths, training_parameters)
+
+    kf = KFold(n_splits = int(training_parameters['train_test_split']['k_folds']),shuffle=True)
+    n_devices = torch.cuda.device_count()
+    n_threads = max(1,(os.cpu_count() or 1)//fold_workers)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = fold_workers, mp_context = context) as executor:
+
+        folds = {}
+        for k_count, (train_idx, test_idx) in enumerate(kf.split(image_paths), start = 1):
+
+            train_images = [image_paths[i] for i in train_idx]
+            test_images = [image_paths[i] for i in test_idx]
+            train_labels = [label_paths[i] for i in train_idx]
+            test_labels = [label_paths[i] for i in test_idx]
+
+            nept_run.assign({f'{k_count}_Training_Set':train_images})
+            nept_run.assign({f'{k_count}_Testing_Set':test_images})
+
+            fold_parameters = dict(training_parameters)
+            fold_parameters['output_dir'] = os.path.join(output_dir,f'Fold_{k_count}')
+            fold_parameters['current_k_fold'] = k_count
+            os.makedirs(fold_parameters['output_dir'], exist_ok = True)
+
+            device_index = (k_count-1)%n_devices if n_devices>0 else None
+
+            folds[k_count] = executor.submit(run_fold,k_count,train_images,train_labels,test_images,test_labels,fold_parameters,device_index,n_threads)
+
+        # Combining metrics from every fold
+        fold_metrics = []
+        for k_count, fold in folds.items():
+            model_path = fold.result()
+            print(f'Finished k-fold: {k_count}, model: {model_path}')
+
+            fold_dir = os.path.join(output_dir,f'Fold_{k_count}')
+            loss_path = os.path.join(fold_dir,'Training_Validation_Loss.csv')
+            if os.path.exists(loss_path):
+                nept_run[f'Training_Validation_Loss_{k_count}'].upload(loss_path)
+
+            metrics_path = os.path.join(fold_dir,'Testing_Output','Test_Metrics.csv')
+            if os.path.exists(metrics_path):
+                metrics_df = pd.read_csv(metrics_path,index_col = 0)
+                metrics_df.insert(0,'Fold',k_count)
+                fold_metrics.append(metrics_df)
+
+                for met, value in metrics_df.drop(columns = ['Fold']).mean(numeric_only = True).items():
+                    nept_run[f'{met}_{k_count}'] = value
+
+    if len(fold_metrics)>0:
+        fold_metrics = pd.concat(fold_metrics,ignore_index = True)
+        fold_metrics.to_csv(os.path.join(output_dir,'K_Fold_Metrics.csv'))
+
+        # Mean and standard deviation of the per-fold means
+        fold_means = fold_metrics.groupby('Fold').mean(numeric_only = True)
+        for met in fold_means.columns:
+            nept_run[f'{met}_mean'] = fold_means[met].mean()
+            nept_run[f'{met}_std'] = fold_means[met].std()
+
+        return fold_means
+
+    return None
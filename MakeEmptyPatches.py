@@ -15,6 +15,8 @@ from PIL import Image
 
 from tqdm import tqdm
 
+from Output_Writer import PREDICTION_EXTENSIONS
+
 base_dir = '/blue/pinaki.sarder/samuelborder/Farzad_Fibrosis/020524_DUET_Patches/'
 bf_dir = 'B/'
 output_dir = 'Results/Ensemble_RGB/Testing_Output/'
@@ -29,8 +31,9 @@ for i in tqdm(image_folders):
     # Getting contents of the output_dir
     output_images = os.listdir(base_dir + i + os.sep + output_dir)
 
-    # Getting the difference between these two lists (predictions have a different file extension and _prediction at the end)
-    missing_images = [i for i in bf_images if i.replace('.jpg','_prediction.tif') not in output_images]
+    # Getting the difference between these two lists (predictions have _prediction at the end and any "output_format" extension)
+    output_images = [os.path.splitext(o)[0] for o in output_images if os.path.splitext(o)[-1] in PREDICTION_EXTENSIONS]
+    missing_images = [i for i in bf_images if os.path.splitext(i)[0]+'_prediction' not in output_images]
 
     # Iterating through missing images and creating pseudo-prediction
     for m in missing_images:
@@ -0,0 +1,143 @@
+"""
+
+Saving prediction masks on background threads with a registry of encoders
+
+Predictions are converted to the output dtype and encoded by a pool of writer threads so that encoding and file writes
+happen while the model predicts the next image. At most "writer_queue_size" predictions are waiting to be written.
+
+Encoders ("output_format"):
+- tiff: uncompressed TIFF (default, same as previous outputs)
+- tiff_deflate: deflate (zlib) compressed TIFF
+- tiff_lzw: LZW compressed TIFF (uint8 only)
+- png: PNG (uint8 only)
+- npy: raw numpy array
+
+Output dtypes ("output_dtype"):
+- uint8: predictions are scaled to 0-255 and truncated (default)
+- float16: same 0-255 scale without truncation, CollagenQuantify and CollagenEvaluate thresholds work unchanged
+
+"output_compression_level" sets the deflate/PNG compression level (0-9, default 6).
+
+"""
+
+import numpy as np
+from PIL import Image
+import tifffile
+
+from Background_Writer import BackgroundWriter
+
+
+# name: function(path, array, compression_level)
+ENCODERS = {}
+ENCODER_EXTENSIONS = {}
+ENCODER_DTYPES = {}
+
+OUTPUT_DTYPES = ['uint8','float16']
+
+
+def register_encoder(name, extension, dtypes = OUTPUT_DTYPES):
+    # Adding an encoder function to the registry with the file extension it writes and the dtypes it supports
+    def decorator(function):
+        ENCODERS[name] = function
+        ENCODER_EXTENSIONS[name] = extension
+        ENCODER_DTYPES[name] = dtypes
+        return function
+
+    return decorator
+
+
+@register_encoder('tiff', '.tif')
+def write_tiff(path, array, compression_level = None):
+    tifffile.imwrite(path, array)
+
+
+@register_encoder('tiff_deflate', '.tif')
+def write_tiff_deflate(path, array, compression_level = None):
+    tifffile.imwrite(path, array, compression = 'zlib', compressionargs = {'level': 6 if compression_level is None else compression_level})
+
+
+@register_encoder('tiff_lzw', '.tif', dtypes = ['uint8'])
+def write_tiff_lzw(path, array, compression_level = None):
+    # PIL's libtiff LZW encoder (tifffile needs imagecodecs for LZW)
+    Image.fromarray(array).save(path, compression = 'tiff_lzw')
+
+
+@register_encoder('png', '.png', dtypes = ['uint8'])
+def write_png(path, array, compression_level = None):
+    Image.fromarray(array).save(path, compress_level = 6 if compression_level is None else compression_level)
+
+
+@register_encoder('npy', '.npy')
+def write_npy(path, array, compression_level = None):
+    np.save(path, array)
+
+
+# Extensions of prediction files written by any encoder (.tif, .png, .npy)
+PREDICTION_EXTENSIONS = sorted(set(ENCODER_EXTENSIONS.values()))
+
+
+class OutputWriter:
+    def __init__(self,
+                 output_format = 'tiff',
+                 output_dtype = 'uint8',
+                 compression_level = None,
+                 workers = 2,
+                 max_queue = 4):
+        """
+        Pool of "workers" threads encoding predictions with output_format, predictions are written on the calling
+        thread if workers is 0
+        """
+        if not output_format in ENCODERS:
+            raise ValueError(f'Unknown output_format: {output_format}, options are: {list(ENCODERS.keys())}')
+        if not output_dtype in ENCODER_DTYPES[output_format]:
+            raise ValueError(f'output_format: {output_format} does not support output_dtype: {output_dtype}, options are: {ENCODER_DTYPES[output_format]}')
+
+        self.output_format = output_format
+        self.output_dtype = output_dtype
+        self.compression_level = compression_level
+        self.extension = ENCODER_EXTENSIONS[output_format]
+
+        self.writer = BackgroundWriter(
+            max_queue = max_queue,
+            enabled = workers>0,
+            workers = max(1,workers)
+        )
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(
+            output_format = parameters['output_format'] if 'output_format' in parameters else 'tiff',
+            output_dtype = parameters['output_dtype'] if 'output_dtype' in parameters else 'uint8',
+            compression_level = int(parameters['output_compression_level']) if 'output_compression_level' in parameters else None,
+            workers = int(parameters['writer_workers']) if 'writer_workers' in parameters else 2,
+            max_queue = int(parameters['writer_queue_size']) if 'writer_queue_size' in parameters else 4
+        )
+
+    def __repr__(self): return f'{self.__class__.__name__}: output_format = {self.output_format}, output_dtype = {self.output_dtype}, {self.writer}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def encode(self, path, array):
+        if self.output_dtype=='uint8':
+            array = array.astype(np.uint8)
+        else:
+            array = array.astype(np.float16)
+
+        ENCODERS[self.output_format](path, array, self.compression_level)
+
+    def write(self, array, path):
+        """
+        Writing a 0-255 scaled prediction (array is not copied) to path (without extension), returns the full path
+        """
+        path = path+self.extension
+        self.writer.submit(self.encode, path, array)
+
+        return path
+
+    def close(self):
+        # Waiting for every prediction to be written
+        self.writer.close()
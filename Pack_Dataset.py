@@ -0,0 +1,106 @@
+"""
+
+Packing a set of images and labels into a single memory-mapped file
+
+Creates:
+- {output}.dat (images and targets stored contiguously as raw arrays)
+- {output}.json (sidecar index with the name, offset, shape, and dtype of each array)
+
+The packed file can be used in place of image paths (see PackedSegmentationDataSet in Input_Pipeline.py)
+by specifying "packed" in "train_test_split" with "training" and "testing" index files.
+
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from glob import glob
+
+from tqdm import tqdm
+from Image_IO import read_image
+
+import argparse
+
+# Offsets are aligned so that arrays can be viewed with any dtype
+ALIGNMENT = 64
+
+
+def write_array(f, array):
+
+    # Padding to the next aligned offset
+    offset = f.tell()
+    padding = (-offset) % ALIGNMENT
+    f.write(b'\0'*padding)
+
+    array = np.ascontiguousarray(array)
+    f.write(array.tobytes())
+
+    return {'offset': offset+padding, 'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+
+def pack_dataset(image_paths, target_paths, output_path):
+    """
+    Decoding each image (and target) once and writing them to output_path.dat with an index in output_path.json
+
+    image_paths is a list of paths or a list of lists of paths (multi-input images concatenated along channels)
+    """
+    output_dir = os.path.dirname(output_path)
+    if not output_dir=='' and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    records = []
+    with open(output_path+'.dat','wb') as f:
+        for idx in tqdm(range(len(image_paths)),desc='Packing'):
+
+            img_name = image_paths[idx]
+            if type(img_name)==list:
+                img = np.concatenate([read_image(i) for i in img_name],axis=-1)
+                img_name = img_name[0]
+            else:
+                img = read_image(img_name)
+
+            record = {'name': str(img_name), 'image': write_array(f, img)}
+
+            if len(target_paths)>0:
+                record['target'] = write_array(f, read_image(target_paths[idx]))
+
+            records.append(record)
+
+    with open(output_path+'.json','w') as f:
+        json.dump({'data_file': os.path.basename(output_path)+'.dat', 'records': records}, f)
+
+    print(f'Packed {len(records)} images to {output_path}.dat')
+
+
+def main(args):
+
+    if args.names is not None:
+        # Same layout as "training"/"testing" files in train_test_split
+        image_names = pd.read_csv(args.names)['Image_Names'].tolist()
+        image_paths_base = [[i+n for n in image_names] for i in args.image_dir]
+        target_paths = [args.label_dir+n for n in image_names] if args.label_dir is not None else []
+    else:
+        image_paths_base = [sorted(glob(i+'*')) for i in args.image_dir]
+        target_paths = sorted(glob(args.label_dir+'*')) if args.label_dir is not None else []
+
+    if len(image_paths_base)>1:
+        image_paths = [list(i) for i in zip(*image_paths_base)]
+    else:
+        image_paths = image_paths_base[0]
+
+    pack_dataset(image_paths, target_paths, args.output)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Packing images and labels into a single memory-mapped file'
+    )
+
+    parser.add_argument('--image_dir',type=str,nargs='+',help='Image directories (with / at the end), specify two (e.g. DUET and Brightfield) for multi-input images')
+    parser.add_argument('--label_dir',type=str,default=None,help='Label directory (with / at the end), leave out if there are no labels')
+    parser.add_argument('--names',type=str,default=None,help='Optional csv file with an "Image_Names" column (same as the training/testing files used in train_test_split)')
+    parser.add_argument('--output',type=str,help='Output path without extension, creates {output}.dat and {output}.json')
+
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+"""
+
+Pipelined prediction on sets of test images
+
+Reading and preprocessing, model prediction, and saving outputs run at the same time instead of one after the other:
+- loader threads ("loader_workers", default 1) read and preprocess the next sets of images with make_training_set()
+- the main thread runs the model (Test_Network) on one set at a time
+- writer threads ("writer_workers", default 2) encode and save predictions (see Output_Writer)
+
+Stages are connected by bounded queues, at most "prefetch_sets" (default 2) preprocessed sets are waiting for the model
+and at most "writer_queue_size" (default 4) predictions are waiting to be saved.
+
+The model is loaded once for every set.
+
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from Input_Pipeline import make_training_set
+from CollagenSegTest import Test_Network, load_model
+from Output_Writer import OutputWriter
+
+
+def prefetch(function, items, workers = 1, max_prefetch = 2):
+    """
+    Generator of function(item) for each item in order, computed ahead by up to max_prefetch items on worker threads
+    """
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        items = iter(items)
+        pending = deque()
+
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending)==max_prefetch:
+                break
+
+        while len(pending)>0:
+            result = pending.popleft().result()
+
+            # Starting the next item before handing this one over
+            for item in items:
+                pending.append(executor.submit(function, item))
+                break
+
+            yield result
+
+
+def load_test_set(run_paths, parameters):
+    print(f'Preprocessing: {run_paths}')
+    _, dataset_test = make_training_set(
+        'test',
+        None,
+        None,
+        run_paths,
+        [],
+        parameters
+    )
+
+    return dataset_test
+
+
+def run_pipelined_inference(model_file, run_path_sets, nept_run, parameters):
+    """
+    Predicting on each set of image paths in run_path_sets with preprocessing and saving overlapping prediction
+    """
+    loader_workers = int(parameters['loader_workers']) if 'loader_workers' in parameters else 1
+    prefetch_sets = int(parameters['prefetch_sets']) if 'prefetch_sets' in parameters else 2
+
+    model = load_model(model_file, parameters)
+
+    with OutputWriter.from_parameters(parameters) as writer:
+        test_sets = prefetch(
+            lambda run_paths: load_test_set(run_paths, parameters),
+            run_path_sets,
+            workers = loader_workers,
+            max_prefetch = prefetch_sets
+        )
+        for dataset_test in test_sets:
+            Test_Network(model, dataset_test, nept_run, parameters, writer = writer)
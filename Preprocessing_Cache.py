@@ -0,0 +1,138 @@
+"""
+
+Persistent on-disk cache for preprocessed images and targets
+
+Entries are keyed by the hash of the source files, the preprocessing parameters, and the patch coordinates
+so that repeated training, k-fold, and testing runs can skip the pre_transforms completely.
+
+Each entry is stored as:
+- {key}_image.npy (image or stacked image patches)
+- {key}_target.npy (target or stacked target patches)
+- {key}.json (metadata written last, an entry without it is incomplete)
+
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class PreprocessingCache:
+    def __init__(self,
+                 cache_dir: str,
+                 preprocessing: dict):
+
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Any change to the preprocessing parameters results in different keys
+        self.config_hash = hashlib.sha1(json.dumps(preprocessing, sort_keys = True, default = str).encode()).hexdigest()
+
+        # Hashes of files that have already been read
+        self.file_hashes = {}
+
+    def file_hash(self, file_path):
+        # Hashing file contents in chunks
+        file_path = str(file_path)
+        if file_path not in self.file_hashes:
+            file_hash = hashlib.sha1()
+            with open(file_path,'rb') as f:
+                for chunk in iter(lambda: f.read(1<<20), b''):
+                    file_hash.update(chunk)
+
+            self.file_hashes[file_path] = file_hash.hexdigest()
+
+        return self.file_hashes[file_path]
+
+    def item_key(self, img_name, tar_name = None, coords = None):
+        # Combining source file hashes, preprocessing parameters, and patch coordinates into one key
+        if type(img_name)==list:
+            source_hashes = [self.file_hash(i) for i in img_name]
+        else:
+            source_hashes = [self.file_hash(img_name)]
+
+        if tar_name is not None:
+            source_hashes.append(self.file_hash(tar_name))
+        else:
+            source_hashes.append('None')
+
+        key_string = '_'.join(source_hashes+[self.config_hash, str(coords)])
+
+        return hashlib.sha1(key_string.encode()).hexdigest()
+
+    def entry_paths(self, key):
+        return (os.path.join(self.cache_dir,f'{key}_image.npy'),
+                os.path.join(self.cache_dir,f'{key}_target.npy'),
+                os.path.join(self.cache_dir,f'{key}.json'))
+
+    def load(self, key):
+        """
+        Memory-mapping a cached entry, returns None if it is missing, incomplete, or corrupted
+        """
+        image_path, target_path, meta_path = self.entry_paths(key)
+
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path,'r') as f:
+                meta = json.load(f)
+
+            # Copy-on-write so that in-place normalization never modifies the files
+            images = np.load(image_path, mmap_mode = 'c')
+            targets = np.load(target_path, mmap_mode = 'c')
+
+            if not meta['key']==key:
+                raise ValueError('Cache key mismatch')
+            for array, array_meta in zip([images, targets],[meta['image'],meta['target']]):
+                if not list(array.shape)==array_meta['shape'] or not str(array.dtype)==array_meta['dtype']:
+                    raise ValueError('Cache shape or dtype mismatch')
+
+        except (OSError, ValueError, KeyError, json.JSONDecodeError):
+            print(f'Rebuilding corrupted cache entry: {key}')
+            self.remove(key)
+            return None
+
+        if meta['patches']:
+            return [(images[i],targets[i]) for i in range(images.shape[0])]
+        else:
+            return (images, targets)
+
+    def save(self, key, item):
+        """
+        Writing a preprocessed item (image/target pair or list of patch pairs) to the cache
+        """
+        image_path, target_path, meta_path = self.entry_paths(key)
+
+        patches = type(item)==list
+        if patches:
+            images = np.stack([i[0] for i in item],axis=0)
+            targets = np.stack([i[1] for i in item],axis=0)
+        else:
+            images, targets = np.asarray(item[0]), np.asarray(item[1])
+
+        meta = {
+            'key': key,
+            'patches': patches,
+            'image': {'shape': list(images.shape), 'dtype': str(images.dtype)},
+            'target': {'shape': list(targets.shape), 'dtype': str(targets.dtype)}
+        }
+
+        # Writing to temporary files and renaming so that interrupted writes are never read as complete
+        # (temporary files are named by process so that processes sharing a cache don't write to the same file)
+        temp_suffix = f'.{os.getpid()}.tmp'
+        for array, path in zip([images, targets],[image_path, target_path]):
+            with open(path+temp_suffix,'wb') as f:
+                np.save(f, array)
+            os.replace(path+temp_suffix,path)
+
+        with open(meta_path+temp_suffix,'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path+temp_suffix,meta_path)
+
+    def remove(self, key):
+        for path in self.entry_paths(key):
+            if os.path.exists(path):
+                os.remove(path)
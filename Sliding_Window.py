@@ -0,0 +1,214 @@
+"""
+
+Batched sliding-window inference
+
+Predictions for tiles (patches) of an image are added to a preallocated float32 accumulator along with a per-pixel
+weight, the final prediction is the weighted mean of overlapping tiles. Tiles are predicted in batches of "batch_size"
+and the accumulator stays on the accumulator device (the model's device by default) until the image is finished, so
+there is a single device to host copy per image instead of one per patch.
+
+Tiles either come from a dataset along with their (row, column) coordinates (add_batch() and add_tiles()) or are cut
+from a whole preprocessed image using the tile size and stride (predict()).
+
+Each tile's prediction is multiplied by a blending kernel ("blending") that is highest in the center of the tile and
+falls off towards the edges, so predictions near tile borders (with less context) contribute less where tiles overlap
+and there are no grid lines at tile borders:
+- uniform: every pixel has the same weight (plain mean of overlapping tiles)
+- gaussian: Gaussian with standard deviation "blending_sigma" (fraction of the tile size, default 0.125)
+- cosine: Hann window
+- linear: linear ramp from the center to the edges
+Kernels are computed once per tile size and kept on the accumulator device.
+
+"""
+
+import torch
+import numpy as np
+from functools import lru_cache
+
+from CollagenSegUtils import to_memory_format
+
+
+BLENDING = ['uniform','gaussian','cosine','linear']
+
+
+def window_starts(length, tile, stride):
+    # Start positions of windows covering [0, length), the last window is aligned with the end
+    if length<=tile:
+        return [0]
+
+    starts = list(range(0,length-tile+1,stride))
+    if not starts[-1]==length-tile:
+        starts.append(length-tile)
+
+    return starts
+
+
+def window_coordinates(image_size, tile_size, stride):
+    # (row, column) of the top left corner of each window
+    return [(r,c) for r in window_starts(image_size[0],tile_size[0],stride[0]) for c in window_starts(image_size[1],tile_size[1],stride[1])]
+
+
+@lru_cache(maxsize = 8)
+def blending_kernel(tile_shape, blending = 'gaussian', sigma = 0.125, min_weight = 1e-3):
+    """
+    (H,W) float32 weights of each pixel in a tile, scaled to a maximum of 1
+
+    Weights are at least min_weight so that image borders only covered by tile edges are still defined.
+    """
+    if not blending in BLENDING:
+        raise ValueError(f'Unknown blending: {blending}, options are: {BLENDING}')
+
+    profiles = []
+    for length in tile_shape:
+        # Pixel centers in [0, 1]
+        x = (np.arange(length)+0.5)/length
+        if blending=='uniform':
+            profile = np.ones(length)
+        elif blending=='gaussian':
+            profile = np.exp(-0.5*((x-0.5)/sigma)**2)
+        elif blending=='cosine':
+            profile = np.sin(np.pi*x)**2
+        elif blending=='linear':
+            profile = 1-np.abs(2*x-1)
+        profiles.append(profile)
+
+    kernel = np.outer(profiles[0],profiles[1])
+    kernel = np.maximum(kernel/np.max(kernel),min_weight).astype(np.float32)
+    # Cached arrays are shared
+    kernel.setflags(write = False)
+
+    return kernel
+
+
+class SlidingWindowInference:
+    def __init__(self,
+                 model,
+                 tile_size: list,
+                 stride = None,
+                 overlap = 0.25,
+                 batch_size = 8,
+                 device = None,
+                 accumulator_device = None,
+                 parameters = {}):
+        """
+        Sliding-window prediction with model (already on device and in eval mode)
+
+        stride is [rows, columns] (defaults to tile_size*(1-overlap)), accumulator_device can be "cpu" for images that
+        are too large for the model's device (e.g. whole slides). parameters is used for the memory format ("channels_last")
+        and the blending kernel ("blending", default "gaussian", and "blending_sigma").
+        """
+        self.model = model
+        self.tile_size = [int(i) for i in tile_size[0:2]]
+        if stride is None:
+            stride = [max(1,int(i*(1-overlap))) for i in self.tile_size]
+        self.stride = [int(i) for i in stride[0:2]]
+        self.batch_size = batch_size
+        self.parameters = parameters
+        self.blending = parameters['blending'] if 'blending' in parameters else 'gaussian'
+        self.blending_sigma = float(parameters['blending_sigma']) if 'blending_sigma' in parameters else 0.125
+        if not self.blending in BLENDING:
+            raise ValueError(f'Unknown blending: {self.blending}, options are: {BLENDING}')
+
+        if device is None:
+            device = next(model.parameters()).device
+        self.device = torch.device(device)
+        self.accumulator_device = self.device if accumulator_device is None else torch.device(accumulator_device)
+
+        self.prediction = None
+        self.weight = None
+        self.kernels = {}
+
+    def __repr__(self): return f'{self.__class__.__name__}: tile_size = {self.tile_size}, stride = {self.stride}, batch_size = {self.batch_size}, blending = {self.blending}'
+
+    def start(self, image_size, n_channels = 1):
+        """
+        Allocating the accumulators for a new image with size [height, width]
+        """
+        self.prediction = torch.zeros((n_channels,image_size[0],image_size[1]), dtype = torch.float32, device = self.accumulator_device)
+        self.weight = torch.zeros((1,image_size[0],image_size[1]), dtype = torch.float32, device = self.accumulator_device)
+
+    def tile_weight(self, tile_shape):
+        # Blending kernel for tiles of this size, computed once and kept on the accumulator device
+        tile_shape = tuple(int(i) for i in tile_shape)
+        if not tile_shape in self.kernels:
+            kernel = blending_kernel(tile_shape, self.blending, self.blending_sigma)
+            self.kernels[tile_shape] = torch.tensor(kernel, device = self.accumulator_device)[None]
+
+        return self.kernels[tile_shape]
+
+    def add_batch(self, tiles, coords):
+        """
+        Predicting a (N,C,H,W) batch of tiles and adding them to the accumulators at coords, a list of (row, column)
+        """
+        with torch.no_grad():
+            pred_batch = self.model(to_memory_format(tiles.to(self.device, non_blocking = True), self.parameters)).float()
+            pred_batch = pred_batch.to(self.accumulator_device)
+
+            if self.prediction is None:
+                raise RuntimeError('start() has to be called before adding tiles')
+            if not pred_batch.shape[1]==self.prediction.shape[0]:
+                self.prediction = torch.zeros((pred_batch.shape[1],*self.prediction.shape[1:]), dtype = torch.float32, device = self.accumulator_device)
+
+            weight = self.tile_weight(pred_batch.shape[-2:])
+            for pred, (row_start, col_start) in zip(pred_batch, coords):
+                # Tiles past the edge of the image (images smaller than a tile) are cropped
+                row_end = min(row_start+pred.shape[-2], self.prediction.shape[-2])
+                col_end = min(col_start+pred.shape[-1], self.prediction.shape[-1])
+                rows, cols = row_end-row_start, col_end-col_start
+
+                self.prediction[:,row_start:row_end,col_start:col_end] += pred[:,0:rows,0:cols]*weight[:,0:rows,0:cols]
+                self.weight[:,row_start:row_end,col_start:col_end] += weight[:,0:rows,0:cols]
+
+        return pred_batch
+
+    def add_tiles(self, tiles):
+        """
+        Predicting tiles from an iterable of (tile, (row, column)) in batches, tiles are (C,H,W) or (1,C,H,W)
+        """
+        batch, coords = [], []
+        for tile, tile_coords in tiles:
+            batch.append(tile if tile.dim()==4 else tile[None])
+            coords.append(tile_coords)
+
+            if len(batch)==self.batch_size:
+                self.add_batch(torch.cat(batch,dim=0), coords)
+                batch, coords = [], []
+
+        if len(batch)>0:
+            self.add_batch(torch.cat(batch,dim=0), coords)
+
+    def finish(self):
+        """
+        Weighted mean of the accumulated predictions as a (C,H,W) float32 numpy array (pixels without tiles are 0)
+        """
+        prediction = self.prediction/torch.clamp(self.weight, min = 1e-8)
+        prediction = prediction.cpu().numpy()
+
+        self.prediction = None
+        self.weight = None
+
+        return prediction
+
+    def predict(self, image):
+        """
+        Sliding-window prediction of a whole preprocessed (C,H,W) image (numpy array or tensor)
+        """
+        if not torch.is_tensor(image):
+            image = torch.from_numpy(np.ascontiguousarray(image))
+        image = image.to(self.device).float()
+
+        image_size = list(image.shape[-2:])
+
+        # Zero padding images that are smaller than a tile
+        pad = [max(0,t-s) for t, s in zip(self.tile_size, image_size)]
+        if any(pad):
+            image = torch.nn.functional.pad(image,(0,pad[1],0,pad[0]))
+        self.start(list(image.shape[-2:]))
+
+        coords = window_coordinates(list(image.shape[-2:]), self.tile_size, self.stride)
+        for i in range(0,len(coords),self.batch_size):
+            batch_coords = coords[i:i+self.batch_size]
+            tiles = torch.stack([image[:,r:r+self.tile_size[0],c:c+self.tile_size[1]] for r, c in batch_coords],dim=0)
+            self.add_batch(tiles, batch_coords)
+
+        return self.finish()[:,0:image_size[0],0:image_size[1]]
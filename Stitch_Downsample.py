@@ -14,6 +14,9 @@ from skimage.filters import gaussian, threshold_otsu
 from PIL import Image
 from tqdm import tqdm
 
+from Image_IO import read_image
+from Output_Writer import PREDICTION_EXTENSIONS
+
 from scipy.ndimage import distance_transform_edt
 from matplotlib import cm as colormap
 
@@ -22,7 +25,7 @@ def get_patch_coordinates(patch_name):
     """
     Getting Y and X coordinates from patch names for reconstruction
     """
-    coords = patch_name.split('.sci ')[-1].replace('_prediction.tif','')
+    coords = os.path.splitext(patch_name.split('.sci ')[-1])[0].replace('_prediction','')
     try:
         x_coord = int(float(coords.split(' ')[-1].replace('X','').lstrip('0')))
     except ValueError:
@@ -54,8 +57,7 @@ def get_distance_transform_image(output_array):
 def main():
     
     base_dir = '/blue/pinaki.sarder/samuelborder/Farzad_Fibrosis/020524_DUET_Patches/'
-    slides = os.listdir(base_dir)
-    #slides = [i for i in slides if os.path.isdir(base_dir+i)]
+    slides = [i for i in os.listdir(base_dir) if os.path.isdir(base_dir+i)]
     slides = ['4H','8H','16H','44H-bottom core','45H','50H']
     print(f'Found: {len(slides)} slides')
 
@@ -83,8 +85,12 @@ def main():
 
                 # Checking if there's anything in each pred patch
                 checked_names = []
-                for p in os.listdir(slide_pred_dir):
-                    patch_img = np.array(Image.open(slide_pred_dir+p))
+                for p in sorted(os.listdir(slide_pred_dir)):
+                    # Only prediction files (written with any "output_format")
+                    if not os.path.splitext(p)[-1] in PREDICTION_EXTENSIONS:
+                        continue
+
+                    patch_img = read_image(slide_pred_dir+p)
                     patch_shape = np.shape(patch_img)
 
                     if np.sum(patch_img)>0:
@@ -125,7 +131,7 @@ def main():
                 stitch_inputs = True
                 #print(f'downsampled mask size: {stitched_downsampled_mask.shape}')
                 for y,x,name in zip(y_coords,x_coords,checked_names):
-                    checked_patch = np.array(Image.open(slide_pred_dir+name))[0:-(patch_overlap+1),0:-(patch_overlap+1)]
+                    checked_patch = read_image(slide_pred_dir+name)[0:-(patch_overlap+1),0:-(patch_overlap+1)]
                     resized_patch = resize(checked_patch,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample)])
 
                     # Where should this patch go?
@@ -137,9 +143,15 @@ def main():
                     stitched_downsampled_mask[y_start:int(y_start+resized_patch.shape[0]),x_start:int(x_start+resized_patch.shape[1])] += np.uint8(255*resized_patch)
                     
                     if stitch_inputs:
-                        checked_bf = np.array(Image.open(slide_b_dir+name.replace('_prediction.tif','.jpg')))[0:-(patch_overlap+1),0:-(patch_overlap+1),:]
+                        # Decoding inputs at reduced resolution, overlap is scaled to the decoded size
+                        image_name = os.path.splitext(name)[0].replace('_prediction','')+'.jpg'
+                        checked_bf = read_image(slide_b_dir+image_name,downsample = downsample)
+                        bf_overlap = int(round((patch_overlap+1)*checked_bf.shape[0]/patch_shape[0]))
+                        checked_bf = checked_bf[0:-bf_overlap,0:-bf_overlap,:]
                         resized_bf = resize(checked_bf,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample),3])
-                        checked_f = np.array(Image.open(slide_f_dir+name.replace('_prediction.tif','.jpg')))[0:-(patch_overlap+1),0:-(patch_overlap+1),:]
+                        checked_f = read_image(slide_f_dir+image_name,downsample = downsample)
+                        f_overlap = int(round((patch_overlap+1)*checked_f.shape[0]/patch_shape[0]))
+                        checked_f = checked_f[0:-f_overlap,0:-f_overlap,:]
                         resized_f = resize(checked_f,output_shape = [int(checked_patch.shape[0]/downsample),int(checked_patch.shape[1]/downsample),3])
 
                         stitched_downsampled_bf[y_start:int(y_start+resized_patch.shape[0]),x_start:int(x_start+resized_patch.shape[1]),:] += np.uint8(255*resized_bf)
@@ -0,0 +1,176 @@
+"""
+
+Opt-in timing of each training step
+
+Records time spent in each phase of a step (waiting for data, host to device copies, forward, backward, optimizer step,
+validation, and checkpointing), samples per second, peak resident memory of the process, and peak device memory.
+
+When enabled, CUDA is synchronized at the end of each phase so that GPU work is attributed to the phase that launched it
+(this adds some overhead, so profiling is off by default).
+
+Outputs (in output_dir):
+- Training_Profile.csv: one row per step
+- Training_Profile_Summary.json: mean time per phase, fraction of step time spent waiting for data, throughput
+- Training_Trace.json: optional torch.profiler (chrome) trace for a window of steps
+
+"""
+
+import os
+import json
+import time
+import resource
+from contextlib import nullcontext
+
+import pandas as pd
+import torch
+
+
+PHASES = ['data','copy','forward','backward','optimizer','validation','checkpoint']
+
+
+class TrainingProfiler:
+    def __init__(self,
+                 enabled = False,
+                 device = 'cpu',
+                 output_dir = None,
+                 nept_run = None,
+                 trace_steps = None):
+        """
+        Step timing, trace_steps is an optional [start, end) window of steps recorded with torch.profiler
+        """
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.output_dir = output_dir
+        self.nept_run = nept_run
+        self.trace_steps = trace_steps
+
+        self.rows = []
+        self.current = None
+        self.trace = None
+
+    def __repr__(self): return f'{self.__class__.__name__}: enabled = {self.enabled}, trace_steps = {self.trace_steps}'
+
+    def synchronize(self):
+        if self.device.type=='cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start_step(self, step):
+        if not self.enabled:
+            return
+
+        if self.trace_steps is not None and step==self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type=='cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities = activities, profile_memory = True)
+            self.trace.__enter__()
+
+        if self.device.type=='cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        self.current = dict({'Step': step}, **{phase: 0.0 for phase in PHASES})
+        self.step_start = time.perf_counter()
+
+    def phase(self, name):
+        """
+        Context manager adding the time spent inside it to the current step's phase
+        """
+        if not self.enabled or self.current is None:
+            return nullcontext()
+
+        return PhaseTimer(self, name)
+
+    def end_step(self, n_samples):
+        if not self.enabled or self.current is None:
+            return
+
+        self.synchronize()
+        step_time = time.perf_counter()-self.step_start
+
+        row = self.current
+        row['step_time'] = step_time
+        row['samples_per_second'] = n_samples/step_time
+        # ru_maxrss is in kilobytes on Linux
+        row['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        if self.device.type=='cuda':
+            row['peak_device_mb'] = torch.cuda.max_memory_allocated(self.device)/(1024**2)
+
+        self.rows.append(row)
+        self.current = None
+
+        if self.nept_run is not None:
+            for key, value in row.items():
+                if not key=='Step':
+                    self.nept_run[f'profile/{key}'].log(value)
+
+        if self.trace is not None and row['Step']==self.trace_steps[1]-1:
+            self.stop_trace()
+
+    def stop_trace(self):
+        self.trace.__exit__(None, None, None)
+        if self.output_dir is not None:
+            self.trace.export_chrome_trace(os.path.join(self.output_dir,'Training_Trace.json'))
+        self.trace = None
+
+    def summary(self):
+        # Mean time per phase and throughput over every recorded step
+        profile_df = pd.DataFrame.from_records(self.rows)
+        step_time = profile_df['step_time'].sum()
+
+        summary = {
+            'steps': len(profile_df),
+            'mean_step_time': float(profile_df['step_time'].mean()),
+            'mean_phase_time': {phase: float(profile_df[phase].mean()) for phase in PHASES},
+            'phase_fraction': {phase: float(profile_df[phase].sum()/step_time) for phase in PHASES},
+            'samples_per_second': float(profile_df['samples_per_second'].mean()),
+            'peak_rss_mb': float(profile_df['peak_rss_mb'].max())
+        }
+        if 'peak_device_mb' in profile_df:
+            summary['peak_device_mb'] = float(profile_df['peak_device_mb'].max())
+
+        # Time spent waiting for data compared to (synchronized) compute time
+        compute_time = sum([profile_df[phase].sum() for phase in ['copy','forward','backward','optimizer']])
+        summary['input_bound'] = bool(profile_df['data'].sum()>compute_time)
+
+        return summary
+
+    def save(self):
+        if not self.enabled or len(self.rows)==0:
+            return
+
+        if self.trace is not None:
+            self.stop_trace()
+
+        summary = self.summary()
+        if self.output_dir is not None:
+            pd.DataFrame.from_records(self.rows).to_csv(os.path.join(self.output_dir,'Training_Profile.csv'))
+            with open(os.path.join(self.output_dir,'Training_Profile_Summary.json'),'w') as f:
+                json.dump(summary, f, indent = 4)
+
+        if self.nept_run is not None:
+            self.nept_run['profile_summary'] = summary
+
+        print(f'Training profile: {summary}')
+
+        return summary
+
+
+class PhaseTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        # Phases are labeled in torch.profiler traces
+        if self.profiler.trace is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.synchronize()
+        self.profiler.current[self.name] += time.perf_counter()-self.start
+        if self.record is not None:
+            self.record.__exit__(*args)
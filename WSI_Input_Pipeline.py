@@ -6,13 +6,11 @@ WSI-level prediction of collagen content using model trained on patches
 
 import os
 import numpy as np
-import pandas as pd
-from math import floor
+from math import ceil
 
 from tqdm import tqdm
 from glob import glob
 
-from PIL import Image
 import tifffile as ti
 #import ome_types as ot
 
@@ -20,9 +18,7 @@ import torch
 from torch.utils.data import Dataset
 
 from Augmentation_Functions import normalize_01
-
-from histolab.tiler import GridTiler
-from histolab.slide import Slide
+from WSI_Reader import SlideReader, tissue_coordinates
 
 import datetime
 
@@ -32,7 +28,12 @@ class WSISegmentationDataSet(Dataset):
                 target_type: str,
                 batch_size: int,
                 wsi_dir:str,
+                pixel_overlap: int = 128,
+                tissue_percent: float = 1.0
                 ):
+        """
+        Batches of 512x512 tiles read directly from each slide (*.svs) in wsi_dir, background tiles are skipped
+        """
 
         self.wsi_dir = wsi_dir
         self.target_type = target_type
@@ -40,6 +41,8 @@ class WSISegmentationDataSet(Dataset):
         self.slide_idx = -1
         self.patch_size = 512
         self.batch_size = batch_size
+        self.pixel_overlap = pixel_overlap
+        self.tissue_percent = tissue_percent
 
         if target_type == 'binary':
             self.target_dtype = torch.long
@@ -49,7 +52,7 @@ class WSISegmentationDataSet(Dataset):
         self.slides = []
         wsi_filenames = glob(self.wsi_dir+'/*.svs')
         for i in tqdm(range(len(wsi_filenames))):
-            self.slides.append(Slide(wsi_filenames[i],wsi_filenames[i].replace('.svs','_processed_path/')))
+            self.slides.append(SlideReader(wsi_filenames[i]))
         
     def __len__(self):
         return len(self.slides)
@@ -60,38 +63,25 @@ class WSISegmentationDataSet(Dataset):
         if self.slide_idx<len(self.slides):
             self.current_slide = self.slides[self.slide_idx]
 
-            # Initialize prediction mask (reversed so it is height X width)
-            self.combined_mask = np.zeros(self.current_slide.dimensions[::-1])
-
             if not self.slide_idx==0:
-                previous_slide = self.slides[self.slide_idx-1]
-                os.rmdir(previous_slide._processed_path)
-
-            self.grid_extractor = GridTiler(
-                tile_size = (self.patch_size,self.patch_size),
-                level = 0,
-                tissue_percent = 1.0,
-                pixel_overlap = 500
+                self.slides[self.slide_idx-1].close()
+
+            # Locations of tiles containing tissue (from a thumbnail), tiles are read when they are predicted
+            print(f'Finding tissue start: {datetime.datetime.now()}')
+            self.patch_coords = tissue_coordinates(
+                self.current_slide,
+                tile_size = [self.patch_size,self.patch_size],
+                stride = [self.patch_size-self.pixel_overlap,self.patch_size-self.pixel_overlap],
+                tissue_percent = self.tissue_percent
             )
-
-            # Saves extracted tiles to processed directory for each slide
-            if not os.path.exists(self.current_slide._processed_path):
-                print(f'Extracting tiles start: {datetime.datetime.now()}')
-                self.grid_extractor.extract(self.current_slide)
-                print(f'Extracting tiles stop: {datetime.datetime.now()}')
-            self.patch_dir = glob(self.current_slide._processed_path+'*.png')
+            print(f'Finding tissue stop: {datetime.datetime.now()}, {len(self.patch_coords)} tiles')
             self.patch_idx = 0
 
-            self.batches = round(len(self.patch_dir)/self.batch_size)
+            self.batches = ceil(len(self.patch_coords)/self.batch_size)
             
             return self
         else:
             raise StopIteration
-  
-    def add_to_mask(self,pred_batch,coordinates):
-        for idx,coords in enumerate(coordinates):
-            self.combined_mask[coords[1]:coords[3],coords[0]:coords[2]]+=np.mean(np.concatenate((self.combined_mask[coords[1]:coords[3],coords[0]:coords[2],None],
-                                                                                    pred_batch[idx,1,:,:,None]),axis=-1))
 
     def make_ome_tiff(self,cyz = False):
 
@@ -102,15 +92,15 @@ class WSISegmentationDataSet(Dataset):
 
         img = img.astype(np.uint8)
         
-        tiff_writer = ti.TiffWriter(self.current_slide._processed_path+'slide_tiff.ome.tiff',ome=True,bigtiff=True)
+        tiff_writer = ti.TiffWriter(os.path.splitext(self.current_slide.path)[0]+'_slide_tiff.ome.tiff',ome=True,bigtiff=True)
         if cyz:
             tiff_writer.write(img,metadata={'axes':'CYX'})
         else:
             tiff_writer.write(img,metadata={'axes':'XYC'})
         tiff_writer.close()
 
-        tiff_file = ot.from_tiff(self.current_slide._processed_path+'slide_tiff.ome.tiff')
-        xml_name = self.current_slide._processed_path+'slide_tiff.ome.xml'
+        tiff_file = ot.from_tiff(os.path.splitext(self.current_slide.path)[0]+'_slide_tiff.ome.tiff')
+        xml_name = os.path.splitext(self.current_slide.path)[0]+'_slide_tiff.ome.xml'
         xml_data = ot.to_xml(tiff_file)
         xml_data = xml_data.replace('<Pixels','<Pixels PhysicalSizeXUnit="\u03BCm" PhysicalSizeYUnit="u03BCm"')
         with open(xml_name,'wt+') as fh:
@@ -118,7 +108,7 @@ class WSISegmentationDataSet(Dataset):
 
     def make_tiff(self,save_path = None):
         if save_path is None:
-            tiff_writer = ti.TiffWriter(self.current_slide._processed_path+'slide_tiff.tiff',ome=False,bigtiff=True)
+            tiff_writer = ti.TiffWriter(os.path.splitext(self.current_slide.path)[0]+'_slide_tiff.tiff',ome=False,bigtiff=True)
         else:
             tiff_writer = ti.TiffWriter(save_path,ome=False,bigtiff=True)
 
@@ -127,32 +117,25 @@ class WSISegmentationDataSet(Dataset):
 
     def __next__(self):
         
-        # Getting new batch of images from slide processed path
-        remaining_patches = len(self.patch_dir)-self.patch_idx
+        # Reading the next batch of tiles from the slide
+        remaining_patches = len(self.patch_coords)-self.patch_idx
 
         if remaining_patches == 0:
             raise StopIteration
         else:
-            if self.batch_size<=remaining_patches:
-                batch_img_paths = self.patch_dir[self.patch_idx:self.patch_idx+self.batch_size]
-                self.patch_idx+=self.batch_size
-            else:
-                batch_img_paths = self.patch_dir[self.patch_idx:self.patch_idx+remaining_patches]
+            batch_coords = self.patch_coords[self.patch_idx:self.patch_idx+min(self.batch_size,remaining_patches)]
+            self.patch_idx+=len(batch_coords)
 
             batch_img_list = []
             coords_list = []
-            for img in batch_img_paths:
+            for row, col in batch_coords:
 
-                current_img = normalize_01(np.array(Image.open(img))[:,:,0:3])
+                current_img = normalize_01(self.current_slide.read_region(row,col,[self.patch_size,self.patch_size]))
                 current_img = np.moveaxis(current_img,source=-1,destination=0)
                 batch_img_list.append(current_img)
 
-                coords = img.split('_')[-1].replace('.png','').split('-')
-                coords_list.append([int(i) for i in coords])
+                coords_list.append([row,col])
 
             batch_img_list = torch.from_numpy(np.stack(batch_img_list,axis=0)).type(torch.float32)
 
             return batch_img_list, coords_list
-
-
-
@@ -23,6 +23,9 @@ import neptune.new as neptune
 
 import datetime
 
+from CollagenSegUtils import get_precision, autocast, to_memory_format
+from Sliding_Window import SlidingWindowInference
+
 def Test_Network(model_path,test_dataset,test_parameters):
 
     device = torch.device('cuda') if torch.cuda.is_available() else 'cpu'
@@ -45,22 +48,38 @@ def Test_Network(model_path,test_dataset,test_parameters):
     model.to(device)
     model.eval()
 
+    # Mixed precision ("precision") and memory format ("channels_last")
+    precision = get_precision(test_parameters, device)
+    model = to_memory_format(model, test_parameters)
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    with torch.no_grad():
+    # Slide-sized accumulators are kept in host memory
+    engine = SlidingWindowInference(
+        model,
+        tile_size = [test_dataset.patch_size,test_dataset.patch_size],
+        batch_size = test_dataset.batch_size,
+        device = device,
+        accumulator_device = 'cpu',
+        parameters = test_parameters
+    )
+
+    with torch.no_grad(), autocast(device, precision):
 
         test_dataloader = iter(test_dataset)
 
         for i in range(len(test_dataloader.slides)):
             print(f'Starting Predictions: {datetime.datetime.now()}')
+            engine.start(test_dataloader.current_slide.dimensions[::-1], n_channels = n_classes)
             for j in tqdm(range(test_dataloader.batches)):
 
+                # Tiles are read from the slide with their (row, column) coordinates
                 img_batch, coords = next(test_dataloader)
-                pred_masks = model.predict(img_batch.to(device))
+                engine.add_batch(img_batch, coords)
 
-                # Assembling predicted masks into combined tif file
-                test_dataloader.add_to_mask(pred_masks.detach().cpu().numpy(),coords)
+            # Assembling predicted masks into combined tif file (collagen channel for binary targets)
+            test_dataloader.combined_mask = engine.finish()[-1]
             
             #final_mask = Image.fromarray(test_dataloader.combined_mask)
             #final_mask.save(output_dir+test_dataloader.current_slide.name+'.tif')
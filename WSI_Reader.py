@@ -0,0 +1,123 @@
+"""
+
+Streaming tiles from whole slide images (WSI)
+
+Tile regions are read directly from the slide file (no tiles are written to disk):
+- OpenSlide (openslide-python) if installed, any format OpenSlide supports
+- tifffile with zarr otherwise, pyramidal TIFF/SVS files (JPEG compressed tiles also need imagecodecs)
+
+Background is skipped using a tissue mask computed on a thumbnail of the slide (Otsu threshold of the grayscale
+thumbnail), only tiles with at least "tissue_percent" percent tissue are read.
+
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from scipy.ndimage import binary_fill_holes
+from skimage.filters import threshold_otsu
+
+try:
+    import openslide
+except ImportError:
+    openslide = None
+
+try:
+    import tifffile
+    import zarr
+except ImportError:
+    zarr = None
+
+from Sliding_Window import window_coordinates
+
+
+class SlideReader:
+    def __init__(self, path: str):
+        """
+        Level 0 region access to a slide, dimensions are (width, height) (same as OpenSlide)
+        """
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+
+        if openslide is not None:
+            self.slide = openslide.OpenSlide(path)
+            self.dimensions = self.slide.dimensions
+
+        elif zarr is not None:
+            self.slide = tifffile.TiffFile(path)
+            self.levels = [zarr.open(self.slide.series[0].aszarr(level = i), mode = 'r') for i in range(len(self.slide.series[0].levels))]
+            # Levels are (height, width, channels)
+            self.dimensions = (self.levels[0].shape[1], self.levels[0].shape[0])
+
+        else:
+            raise ImportError('Reading slides requires openslide-python or tifffile with zarr')
+
+    def __repr__(self): return f'{self.__class__.__name__}: {self.name}, dimensions = {self.dimensions}'
+
+    def read_region(self, row, col, size):
+        """
+        RGB uint8 (size[0], size[1], 3) array with its top left corner at (row, col) of level 0
+        """
+        if openslide is not None:
+            # OpenSlide regions are transparent past the edge of the slide, these are padded with white background
+            region = np.array(self.slide.read_region((col,row), 0, (size[1],size[0])))
+            region[region[:,:,3]==0,0:3] = 255
+            return region[:,:,0:3]
+
+        region = np.asarray(self.levels[0][row:row+size[0],col:col+size[1]])
+        if region.ndim==2:
+            region = np.stack((region,)*3,axis=-1)
+
+        # Regions past the edge of the slide are padded with white background
+        if not region.shape[0:2]==tuple(size):
+            padded = np.full((size[0],size[1],3),255,dtype=np.uint8)
+            padded[0:region.shape[0],0:region.shape[1]] = region[:,:,0:3]
+            region = padded
+
+        return region[:,:,0:3]
+
+    def thumbnail(self, max_size = 2048):
+        """
+        RGB uint8 thumbnail no larger than max_size on either side
+        """
+        if openslide is not None:
+            return np.array(self.slide.get_thumbnail((max_size,max_size)).convert('RGB'))
+
+        # Smallest pyramid level, resized
+        thumbnail = Image.fromarray(np.asarray(self.levels[-1][:])[:,:,0:3])
+        thumbnail.thumbnail((max_size,max_size))
+
+        return np.array(thumbnail)
+
+    def close(self):
+        self.slide.close()
+
+
+def tissue_mask(thumbnail):
+    # Tissue is darker than the (bright) slide background
+    gray = np.mean(thumbnail,axis=-1)
+    if np.ptp(gray)==0:
+        return np.zeros(gray.shape,dtype=bool)
+
+    return binary_fill_holes(gray<threshold_otsu(gray))
+
+
+def tissue_coordinates(slide, tile_size, stride, tissue_percent = 1.0, max_size = 2048):
+    """
+    (row, col) of level 0 tiles covering the slide with at least tissue_percent percent tissue
+    """
+    mask = tissue_mask(slide.thumbnail(max_size))
+    scale = [mask.shape[0]/slide.dimensions[1], mask.shape[1]/slide.dimensions[0]]
+
+    coords = []
+    for row, col in window_coordinates(slide.dimensions[::-1], tile_size, stride):
+        # Tile area in the thumbnail clamped to the slide (at least one pixel, tiles can be larger than the slide)
+        row_start = min(int(row*scale[0]), mask.shape[0]-1)
+        col_start = min(int(col*scale[1]), mask.shape[1]-1)
+        row_end = min(max(row_start+1, int(np.ceil((row+tile_size[0])*scale[0]))), mask.shape[0])
+        col_end = min(max(col_start+1, int(np.ceil((col+tile_size[1])*scale[1]))), mask.shape[1])
+
+        if 100*np.mean(mask[row_start:row_end,col_start:col_end])>=tissue_percent:
+            coords.append((row,col))
+
+    return coords